@@ -27,6 +27,7 @@ from tegrity.settings import (
     CONFIG_PATH_MODE,
     DEFAULT_CONFIG_PATH,
 )
+import tegrity.cache
 import tegrity.cli
 import tegrity.download
 import tegrity.err
@@ -45,9 +46,11 @@ logger = logging.getLogger(__name__)
 try:
     # noinspection PyUnresolvedReferences
     import tegrity.gui
-except ImportError as err:
+except ImportError as gui_err:
+    # not "as err", since except clauses unbind the name and would take
+    # tegrity.err with them
     tegrity.gui = None
-    if err.name == 'gi':
+    if gui_err.name == 'gi':
         logger.debug(
             "gi not available, so tegrity.gui = None and --gui cannot be used."
             "try: sudo apt install python3-gi")
@@ -0,0 +1,193 @@
+# Copyright 2019 Michael de Gans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A download cache in ~/.tegrity/cache for the (large) tarballs tegrity uses, so
+they aren't downloaded from Nvidia, Canonical, or Linaro every time.
+
+Files are stored by the hexdigest they were verified against, as
+~/.tegrity/cache/<hexdigest>/<filename>, so only verified downloads are
+cached. Least recently used entries are pruned when the cache gets too big.
+"""
+
+import glob
+import logging
+import os
+import shutil
+import stat
+import urllib.parse
+
+from typing import (
+    Callable,
+    Optional,
+    Union,
+)
+
+import tegrity
+
+from tegrity.settings import (
+    CACHE_MAX_SIZE,
+    CACHE_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'fetch',
+    'discard',
+    'prune',
+    'trusted',
+]
+
+
+def fetch(file_or_url: str,
+          hexdigest: Union[str, Callable[[], str], None] = None,
+          hasher: Optional[Callable] = None,
+          **kwargs) -> str:
+    """
+    Returns a verified local copy of |file_or_url| from the cache, downloading
+    it to the cache first if it isn't there. Local files, and urls without a
+    |hasher| and |hexdigest| (which can't be cached safely), are returned as
+    is, so the result can always be passed to tegrity.download.extract.
+
+    :param file_or_url: file or url to fetch
+    :param hexdigest: Expected hash from hasher, or a callable returning it
+    (eg. Future.result). It's only called up front if a file by that name is
+    in the cache, otherwise not until the download is done, so a checksum can
+    be fetched at the same time as the file.
+    :param hasher: hasher to use (eg. "hashlib.sha512")
+    :param kwargs: passed to tegrity.download.download()
+
+    :returns: a local path (or |file_or_url| unchanged)
+    """
+    if not (hasher and hexdigest and
+            file_or_url.startswith(('http', 'ftp'))):
+        return file_or_url
+    filename = os.path.basename(urllib.parse.urlparse(file_or_url).path)
+    if callable(hexdigest) and glob.glob(
+            os.path.join(CACHE_PATH, '*', glob.escape(filename))):
+        hexdigest = hexdigest()
+    if not callable(hexdigest):
+        entry = os.path.join(CACHE_PATH, hexdigest)
+        cached = os.path.join(entry, filename)
+        if os.path.isfile(cached):
+            logger.info(f"Using cached {cached}")
+            tegrity.download.verify(cached, hexdigest, hasher)
+            # the entry's mtime is it's last use (the file's own times are
+            # left alone since they key the record of it being verified)
+            os.utime(entry)
+            return cached
+    # download next to the cache so the finished file can be renamed in. A
+    # failed download is left there, so the next fetch can resume it.
+    partial = os.path.join(CACHE_PATH, f"{filename}.part")
+    os.makedirs(partial, 0o755, exist_ok=True)
+    downloaded = tegrity.download.download(
+        file_or_url, partial, hexdigest, hasher, resume=True, **kwargs)
+    if callable(hexdigest):
+        hexdigest = hexdigest()
+    entry = os.path.join(CACHE_PATH, hexdigest)
+    cached = os.path.join(entry, filename)
+    os.makedirs(entry, 0o755, exist_ok=True)
+    os.rename(downloaded, cached)
+    shutil.rmtree(partial, ignore_errors=True)
+    # it was hashed as it downloaded, so it needn't be again to extract
+    # noinspection PyProtectedMember
+    tegrity.download._mark_verified(
+        os.stat(cached), hasher().name, hexdigest)
+    prune(keep=entry)
+    return cached
+
+
+def prune(max_size: int = CACHE_MAX_SIZE,
+          keep: Optional[str] = None,
+          path: str = CACHE_PATH):
+    """
+    removes least recently used cache entries until the cache is no larger
+    than |max_size| bytes. An entry's mtime is it's last use, so callers
+    reusing an entry should os.utime() it.
+
+    :param keep: an entry never to remove (eg. the one just fetched)
+    :param path: the cache to prune. Any folder of entries works this way, so
+    this is also used for KERNEL_SOURCE_CACHE, KBUILD_CACHE and ROOTFS_STAGING
+    """
+    try:
+        entries = [e for e in os.scandir(path)
+                   if e.is_dir(follow_symlinks=False)
+                   and not e.name.endswith('.part')]
+    except FileNotFoundError:
+        return
+    sizes = {e.path: _tree_size(e.path) for e in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_size:
+            break
+        if entry.path == keep:
+            continue
+        logger.info(f"Removing {entry.path} from cache")
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
+
+
+def _tree_size(path) -> int:
+    """:returns: the bytes allocated to everything under |path|"""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except (FileNotFoundError, PermissionError):
+            continue
+    return total
+
+
+def trusted(path) -> bool:
+    """
+    :returns: True if |path| is a folder (not a symlink) owned by the
+    effective user and not writable by anybody else, so a tree cached in it
+    can be reused as is. False (with a warning if it exists) otherwise. Like
+    tegrity.download's record of verified files, caches in a home folder
+    can't be trusted under sudo otherwise.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() \
+            and not st.st_mode & 0o022:
+        return True
+    logger.warning(f"Not using {path} since it isn't a folder owned by uid "
+                   f"{os.geteuid()} or is writable by others.")
+    return False
+
+
+def discard(path):
+    """removes a cache entry |path| (a folder, or anything else in it's place),
+    if it exists. Symlinks are removed, not followed."""
+    try:
+        if stat.S_ISDIR(os.lstat(path).st_mode):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -18,49 +18,101 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import io
+import json
+import mmap
 import logging
 import os
+import queue
+import shutil
+import subprocess
 import tarfile
 import tempfile
+import threading
 import urllib.parse
-import urllib.request
 import zipfile
 
 from typing import (
     Any,
+    BinaryIO,
     Callable,
+    Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
     Text,
+    Tuple,
     Union,
 )
 
 import tegrity
-from tegrity.settings import LBZIP2
+from tegrity.settings import (
+    LBZIP2,
+    PBZIP2,
+    PIGZ,
+    VERIFIED_CACHE,
+    XZ,
+)
 
 logger = logging.getLogger(__name__)
 
+# read size for downloading and hashing. small reads leave slow disks (and
+# the hash) mostly waiting.
+CHUNK_SIZE = 4 * 2**20
+# how many chunks download() may read ahead of writing and hashing them
+PREFETCH_DEPTH = 4
+# how many connections download() splits a large file between, and the
+# smallest range worth a connection of it's own
+CONNECTIONS = 4
+MIN_RANGE_SIZE = 16 * 2**20
+# parallel bzip2 decompressor, if any, used instead of the bz2 module
+BUNZIP2 = LBZIP2 or PBZIP2
+BZIP2_SUFFIXES = ('.bz2', '.tbz2', '.tbz')
+XZ_SUFFIXES = ('.xz', '.txz')
+GZIP_SUFFIXES = ('.gz', '.tgz')
+# tarfile's default of 10 KiB means a lot of small reads on big tarballs
+TAR_BUFSIZE = 2**20
+# hashes a file object in hashlib's own loop (python 3.11+), else None
+FILE_DIGEST = getattr(hashlib, 'file_digest', None)
+
 __all__ = [
     'download',
     'extract',
+    'extract_nested',
     'verify',
 ]
 
 
 def download(url: Text,
              path: str,
-             hexdigest: Optional[str] = None,
+             hexdigest: Union[str, Callable[[], str], None] = None,
              hasher: Optional[Callable[[bytes], Any]] = None,
-             chunk_size=2**20) -> Text:
+             chunk_size=CHUNK_SIZE,
+             resume=False,
+             connections=CONNECTIONS) -> Text:
     """
     Downloads a file at |url| to |path|.
 
     :arg url: as str, bytes
     :arg path: destination path. str, bytes, os.PathLike will all work
 
-    :param hexdigest: Expected hash from hasher
+    :param hexdigest: Expected hash from hasher, or a callable returning it,
+    called once the download is done (eg. the .result of a Future fetching
+    the checksum at the same time)
     :param hasher: hasher to use (eg. "hashlib.md5" hashlib)
     :param chunk_size: chunk size (in bytes) to download in
+    :param resume: if a partial download of |url| was left in |path| by a
+    failed attempt, only request the rest of it (with a http Range request,
+    if the file on the server hasn't changed since). A download that fails
+    verification is removed, so the next attempt starts over.
+    :param connections: how many http Range requests to split a large file
+    between, if the server supports them (it's then hashed after, rather
+    than as it downloads). Per connection bandwidth is often capped.
 
     :return: destination filename
     """
@@ -68,6 +120,8 @@ def download(url: Text,
     url_path = urllib.parse.urlparse(url).path
     filename = os.path.basename(url_path)
     local_dest = os.path.join(path, filename)
+    # the ETag (or Last-Modified) of the partial download, for If-Range
+    validator_file = os.path.join(path, f".{filename}.validator")
 
     # download file in chunks while updating hasher
     logger.debug(f"Downloading {url} to {local_dest}")
@@ -75,32 +129,229 @@ def download(url: Text,
     if hasher and hexdigest:
         hasher = hasher()
         logger.debug(f"Using {hasher.name} to verify download.")
-        logger.debug(f"Expecting hex digest: {hexdigest}")
+        if not callable(hexdigest):
+            logger.debug(f"Expecting hex digest: {hexdigest}")
 
-    with urllib.request.urlopen(url) as response, open(local_dest, 'wb') as f:
-        chunk = response.read(chunk_size)
-        while chunk:
-            f.write(chunk)
-            if hasher and hexdigest:
-                hasher.update(chunk)
-            chunk = response.read(chunk_size)
+    resume = resume and url.startswith('http')
+    size = None
+    if connections > 1 and url.startswith('http') and not (
+            resume and _resume_offset(local_dest, validator_file)):
+        size, validator = _range_info(url)
+    if size and size >= connections * MIN_RANGE_SIZE:
+        # a failed parallel download has holes, so it mustn't be resumed
+        if os.path.exists(validator_file):
+            os.remove(validator_file)
+        _download_ranges(url, local_dest, size, validator, connections,
+                         chunk_size)
+        if hasher and hexdigest:
+            with open(local_dest, 'rb', buffering=0) as f:
+                _hash_into(f, hasher, chunk_size)
+    else:
+        _download_stream(url, local_dest, validator_file,
+                         hasher if hexdigest else None, chunk_size, resume)
 
     # verify hasher result against
     if hasher and hexdigest:
+        if callable(hexdigest):
+            hexdigest = hexdigest()
+            logger.debug(f"Expecting hex digest: {hexdigest}")
         if hasher.hexdigest() != hexdigest:
+            if resume:
+                os.remove(local_dest)
             raise tegrity.err.InTegrityError(
                 f"Hash verification failed for {url}. "
                 f"expected: {hexdigest} but got {hasher.hexdigest()}"
             )
 
+    if resume and os.path.exists(validator_file):
+        os.remove(validator_file)
     return local_dest
 
 
+def _download_stream(url: str, local_dest: str, validator_file: str,
+                     hasher, chunk_size: int, resume: bool):
+    """downloads |url| to |local_dest| over one connection (see download()),
+    updating |hasher| (if not None) as it does"""
+    # imported here since urllib.request pulls in ssl, http and email, which
+    # cli commands that never download shouldn't pay for
+    import urllib.error
+    import urllib.request
+    request = urllib.request.Request(url)
+    offset = 0
+    if resume:
+        offset = _resume_offset(local_dest, validator_file)
+        if offset:
+            with open(validator_file) as f:
+                request.add_header('If-Range', f.read())
+            request.add_header('Range', f'bytes={offset}-')
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as err:
+        # eg. 416 if the partial download is somehow complete already
+        if not offset:
+            raise
+        logger.info(f"Can't resume {url} ({err}). Starting over.")
+        offset = 0
+        response = urllib.request.urlopen(url)
+    with response:
+        if offset and response.getcode() != 206:
+            logger.info(f"Can't resume {url}. Starting over.")
+            offset = 0
+        if resume:
+            _save_validator(response, validator_file)
+        if offset:
+            logger.info(f"Resuming {url} from byte {offset}")
+            if hasher:
+                # hashlib objects can't be saved, so the part already
+                # downloaded is hashed again (from disk, which is quicker
+                # than downloading it again)
+                with open(local_dest, 'rb', buffering=0) as f:
+                    _hash_into(f, hasher, chunk_size)
+        # the network is read by another thread, so the next chunks are on
+        # their way while this one is written and hashed
+        with open(local_dest, 'ab' if offset else 'wb') as f:
+            for chunk in _prefetch(response, chunk_size):
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+
+
+def _range_info(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """:returns: the size of |url| and it's strong ETag (or Last-Modified) if
+    the server accepts byte Range requests for it, otherwise (None, None)"""
+    import urllib.error
+    import urllib.request
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(request) as response:
+            headers = response.headers
+    except urllib.error.URLError as err:
+        logger.debug(f"HEAD {url} failed ({err}). Using one connection.")
+        return None, None
+    if headers.get('Accept-Ranges') != 'bytes' or \
+            not headers.get('Content-Length'):
+        return None, None
+    validator = headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+        validator = headers.get('Last-Modified')
+    return int(headers['Content-Length']), validator
+
+
+def _download_ranges(url: str, local_dest: str, size: int,
+                     validator: Optional[str], connections: int,
+                     chunk_size: int):
+    """downloads the |size| bytes of |url| to |local_dest| as |connections|
+    Range requests at once, each written in place with pwrite. |validator| is
+    sent as If-Range, so ranges of a file changed on the server in the
+    meantime aren't mixed."""
+    import urllib.request
+    logger.debug(f"Downloading {url} over {connections} connections")
+    step = -(-size // connections)
+    ranges = [(start, min(start + step, size) - 1)
+              for start in range(0, size, step)]
+    with open(local_dest, 'wb') as f:
+        f.truncate(size)
+    fd = os.open(local_dest, os.O_WRONLY)
+
+    def fetch(first, last):
+        request = urllib.request.Request(
+            url, headers={'Range': f'bytes={first}-{last}'})
+        if validator:
+            request.add_header('If-Range', validator)
+        offset = first
+        with urllib.request.urlopen(request) as response:
+            if response.getcode() != 206:
+                raise tegrity.err.InTegrityError(
+                    f"{url} changed on the server during download")
+            for chunk in iter(lambda: response.read(chunk_size), b''):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        if offset != last + 1:
+            raise IOError(f"{url} range {first}-{last} ended early")
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+            for future in [executor.submit(fetch, *r) for r in ranges]:
+                future.result()
+    finally:
+        os.close(fd)
+
+
+def _resume_offset(local_dest: str, validator_file: str) -> int:
+    """:returns: the size of a partial download at |local_dest| that can be
+    resumed (it has a |validator_file|), otherwise 0"""
+    if not os.path.isfile(validator_file):
+        return 0
+    try:
+        return os.path.getsize(local_dest)
+    except FileNotFoundError:
+        return 0
+
+
+def _save_validator(response, validator_file: str):
+    """saves the |response|'s strong ETag (or Last-Modified) to
+    |validator_file|, for If-Range if the download has to be resumed.
+    Without either, the download can't be resumed safely."""
+    validator = response.headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+        validator = response.headers.get('Last-Modified')
+    if validator:
+        with open(validator_file, 'w') as f:
+            f.write(validator)
+    elif os.path.exists(validator_file):
+        os.remove(validator_file)
+
+
+def _prefetch(stream: BinaryIO, chunk_size: int,
+              depth=PREFETCH_DEPTH) -> Iterator[bytes]:
+    """
+    Reads |stream| in |chunk_size| chunks on a thread, up to |depth| chunks
+    ahead of the consumer.
+
+    :returns: an iterator of chunks. Errors reading |stream| are raised from
+    it.
+    """
+    chunks = queue.Queue(depth)
+    stopped = threading.Event()
+
+    def reader():
+        try:
+            chunk = stream.read(chunk_size)
+            while chunk and not stopped.is_set():
+                chunks.put(chunk)
+                chunk = stream.read(chunk_size)
+            chunks.put(None)
+        except Exception as err:
+            chunks.put(err)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # if the consumer stopped early, unblock the reader so it can exit
+        stopped.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 # noinspection PyPep8Naming
 def extract(file_or_url: str,
             path: str,
             hexdigest: Optional[str] = None,
             hasher: Optional[Callable] = None,
+            strip_components=0,
+            merge=False,
             **kwargs) -> Union[List[zipfile.ZipInfo], List[tarfile.TarInfo]]:
     """
     (Downloads) and extracts a file or url to path.
@@ -110,6 +361,18 @@ def extract(file_or_url: str,
     :param kwargs: passed to download()
     :param hexdigest: Expected hash from hasher
     :param hasher: hasher to use (eg. "hashlib.md5" hashlib)
+    :param strip_components: (tarballs only) like tar --strip-components,
+    removes this many leading folders from member names. Members left with no
+    name (the folders themselves) are skipped.
+    :param merge: (tarballs only) extract into an existing |path| (like
+    rsync -a into it): existing files are unlinked and replaced rather than
+    written into, existing folders are left as they are, and everything is
+    owned by the current user rather than the owners in the archive.
+
+    Local tarballs are hashed as they're extracted when |path| is new (and
+    removed if the hash doesn't match). When |path| already exists or
+    |merge|, they are verified first instead, so existing files are never
+    replaced with unverified ones.
 
     :returns: an archive file member list
     """
@@ -121,54 +384,506 @@ def extract(file_or_url: str,
     else:
         raise ValueError(f'{file_or_url} has unsupported archive type.')
 
-    with tempfile.TemporaryDirectory() as tmp:
-        if file_or_url.startswith(('http', 'ftp')):
-            file_or_url = download(file_or_url, tmp, hexdigest, hasher,
-                                   **kwargs)
-        elif hasher and hexdigest:
+    if ArkFile is zipfile.ZipFile:
+        if strip_components or merge:
+            raise ValueError(
+                "strip_components and merge are only supported for tarballs")
+        with _fetched(file_or_url, hexdigest, hasher, **kwargs) as file_or_url:
+            logger.debug(f"Extracting {file_or_url} to {path}")
+            with zipfile.ZipFile(file_or_url) as archive:
+                member_list = archive.infolist()
+                _check_members(
+                    path, (member.filename for member in member_list))
+                archive.extractall(path)
+                return member_list
+
+    # local tarballs are hashed as they are extracted, rather than read twice,
+    # if a bad one can be cleaned up after
+    hash_as_extracted = not (merge or os.path.exists(path))
+    with _fetched(file_or_url, hexdigest, hasher,
+                  verify_local=not hash_as_extracted,
+                  **kwargs) as local, _removed_on_error(path):
+        logger.debug(f"Extracting {local} to {path}")
+        with _open_hashed(local, *_local_verify_args(
+                file_or_url, hexdigest, hasher, hash_as_extracted)) as f, \
+                _open_tar_stream(f, local) as archive:
+            return _extract_stream(archive, path, strip_components, merge)
+
+
+def _is_url(file_or_url: str) -> bool:
+    return file_or_url.startswith(('http', 'ftp'))
+
+
+@contextlib.contextmanager
+def _fetched(file_or_url: str,
+             hexdigest: Optional[str] = None,
+             hasher: Optional[Callable] = None,
+             verify_local=True,
+             **kwargs) -> Iterator[str]:
+    """
+    Context manager yielding a local path for |file_or_url|. urls are
+    downloaded (and verified as they are) to a temporary folder that is
+    removed on exit; local files are used in place (no temporary folder is
+    created) and verified first if |verify_local|.
+
+    :param kwargs: passed to download() or verify()
+    """
+    if _is_url(file_or_url):
+        with tempfile.TemporaryDirectory() as tmp:
+            yield download(file_or_url, tmp, hexdigest, hasher, **kwargs)
+    else:
+        if verify_local and hasher and hexdigest:
             verify(file_or_url, hexdigest, hasher, **kwargs)
+        yield file_or_url
+
+
+def _local_verify_args(file_or_url: str,
+                       hexdigest: Optional[str],
+                       hasher: Optional[Callable],
+                       hash_as_extracted=True) -> tuple:
+    """:returns: the (hexdigest, hasher) for _open_hashed, if |file_or_url|
+    still needs verifying (urls are verified by download(), and local files
+    by _fetched unless |hash_as_extracted|)"""
+    if _is_url(file_or_url) or not hash_as_extracted:
+        return ()
+    return hexdigest, hasher
+
+
+@contextlib.contextmanager
+def _removed_on_error(path: str) -> Iterator[None]:
+    """removes |path| if it's created in the context, and an exception is
+    raised (eg. a hash mismatch after it's been partially extracted to)"""
+    created = not os.path.exists(path)
+    try:
+        yield
+    except BaseException:
+        if created and os.path.exists(path):
+            logger.warning(f"Removing partially extracted {path}")
+            shutil.rmtree(path, ignore_errors=True)
+        raise
+
+
+class _HashingReader(io.RawIOBase):
+    """a read only stream that updates a hasher with everything read from it"""
+
+    def __init__(self, raw: BinaryIO, hasher):
+        super().__init__()
+        self._raw = raw
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self._raw.readinto(buffer)
+        if size:
+            self.hasher.update(memoryview(buffer)[:size])
+        return size
+
+
+@contextlib.contextmanager
+def _open_hashed(file: Union[str, os.PathLike],
+                 hexdigest: Optional[str] = None,
+                 hasher: Optional[Callable] = None) -> Iterator[BinaryIO]:
+    """
+    Opens |file| (see _open_sequential). If |hasher| and |hexdigest| are
+    supplied, it is hashed as it's read and verified on exit, including any
+    part left unread.
+
+    :raises: tegrity.err.InTegrityError on exit if the hash doesn't match
+    """
+    with _open_sequential(file) as f:
+        if not (hasher and hexdigest):
+            yield f
+            return
+        hasher = hasher()
+        stat = os.fstat(f.fileno())
+        if _is_verified(stat, hasher.name, hexdigest):
+            logger.debug(f"{file} already verified. Not hashing it again.")
+            yield f
+            return
+        reader = _HashingReader(f, hasher)
+        logger.debug(f"Using {hasher.name} to verify archive.")
+        logger.debug(f"Expecting hex digest: {hexdigest}")
+        yield reader
+        buffer = bytearray(TAR_BUFSIZE)
+        while reader.readinto(buffer):
+            pass
+    if hasher.hexdigest() != hexdigest:
+        raise tegrity.err.InTegrityError(
+            f"Hash verification failed for {file}.  "
+            f"expected: {hexdigest} but got {hasher.hexdigest()}"
+        )
+    _mark_verified(stat, hasher.name, hexdigest)
 
-        logger.debug(f"Extracting {file_or_url} to {path}")
-        with ArkFile.open(file_or_url) as archive:
-            member_list = archive.getmembers()
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(archive, path)
-            return member_list
+
+def _verified_key(stat: os.stat_result) -> str:
+    """:returns: a key that changes if the file with |stat| might have"""
+    return (f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:"
+            f"{stat.st_mtime_ns}:{stat.st_ctime_ns}")
+
+
+def _load_verified() -> Dict[str, str]:
+    """:returns: the VERIFIED_CACHE contents, or {} if it can't be read or
+    can't be trusted (it's records skip hashing, so it must be owned by the
+    effective user and writable by nobody else)"""
+    try:
+        with open(VERIFIED_CACHE) as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_uid != os.geteuid() or stat.st_mode & 0o022:
+                logger.warning(
+                    f"Ignoring {VERIFIED_CACHE} since it isn't owned by "
+                    f"uid {os.geteuid()} or is writable by others.")
+                return {}
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_verified(stat: os.stat_result, name: str, hexdigest: str) -> bool:
+    """:returns: True if a file with |stat| has already been verified to have
+    |hexdigest| (using hasher |name|) and hasn't changed since"""
+    return _load_verified().get(_verified_key(stat)) == f"{name}:{hexdigest}"
+
+
+def _mark_verified(stat: os.stat_result, name: str, hexdigest: str):
+    """records a verified file in VERIFIED_CACHE, if it can be written"""
+    verified = _load_verified()
+    verified[_verified_key(stat)] = f"{name}:{hexdigest}"
+    tmp = f"{VERIFIED_CACHE}.{os.getpid()}"
+    try:
+        # created 0o644 whatever the umask, so _load_verified trusts it
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o644), 'w') as f:
+            os.fchmod(f.fileno(), 0o644)
+            json.dump(verified, f)
+        os.replace(tmp, VERIFIED_CACHE)
+    except OSError as err:
+        logger.debug(f"Could not write {VERIFIED_CACHE} because: {err}")
+
+
+def _fadvise(f: BinaryIO, advice: int):
+    """calls os.posix_fadvise on all of |f|, if available. advice only."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, advice)
+        except OSError as err:
+            logger.debug(f"posix_fadvise failed on {f.name} because: {err}")
+
+
+@contextlib.contextmanager
+def _open_sequential(file: Union[str, os.PathLike]) -> Iterator[BinaryIO]:
+    """
+    opens |file| for reading with a large buffer and advises the kernel it
+    will be read sequentially (so readahead is more aggressive). On exit, the
+    kernel is advised the file's pages can be dropped from the page cache, so
+    a multi GB tarball doesn't evict things that will be used again (like
+    the compiler, during a kernel build).
+    """
+    with open(file, 'rb', buffering=TAR_BUFSIZE) as f:
+        _fadvise(f, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+        try:
+            yield f
+        finally:
+            _fadvise(f, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+
+
+@contextlib.contextmanager
+def _open_tar_stream(fileobj: BinaryIO, name: str) -> Iterator[tarfile.TarFile]:
+    """
+    Opens |fileobj| as a tarfile in stream mode with a large buffer, both for
+    reading the stream and for copying member data out to disk (tarfile uses
+    16 KiB for the latter by default). Compressed tarballs (by |name|) are
+    decompressed by an external decompressor if one is installed (see
+    _decompressor), since it's much faster than the python modules.
+    """
+    command = _decompressor(name)
+    if command:
+        with _decompress(fileobj, command) as stream, \
+                tarfile.open(fileobj=stream, mode='r|', bufsize=TAR_BUFSIZE,
+                             copybufsize=TAR_BUFSIZE) as archive:
+            yield archive
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|*', bufsize=TAR_BUFSIZE,
+                          copybufsize=TAR_BUFSIZE) as archive:
+            yield archive
+
+
+def _decompressor(name: str) -> Optional[tuple]:
+    """
+    :returns: a command decompressing stdin to stdout for an archive |name|,
+    or None if it isn't compressed or there's no decompressor for it. bzip2
+    uses BUNZIP2 (lbzip2 or pbzip2), xz uses xz (with a thread per core, for
+    multi-block files), and gzip uses pigz. Even where these are single
+    threaded, decompressing in another process overlaps it with extraction.
+    """
+    if BUNZIP2 and name.endswith(BZIP2_SUFFIXES):
+        return BUNZIP2, '-dc'
+    if XZ and name.endswith(XZ_SUFFIXES):
+        return XZ, '-dc', '-T0'
+    if PIGZ and name.endswith(GZIP_SUFFIXES):
+        return PIGZ, '-dc'
+
+
+@contextlib.contextmanager
+def _decompress(fileobj: BinaryIO, command: tuple) -> Iterator[BinaryIO]:
+    """
+    Decompresses |fileobj| in a |command| subprocess, yielding it's stdout. If
+    |fileobj| is a real file, it's used as stdin directly, otherwise it's fed
+    to the subprocess by a thread.
+
+    :raises: subprocess.CalledProcessError if the decompressor fails
+    """
+    try:
+        fileobj.fileno()
+        stdin = fileobj
+    except (AttributeError, io.UnsupportedOperation):
+        stdin = subprocess.PIPE
+    logger.debug(f"running: {' '.join(command)}")
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE,
+                               bufsize=TAR_BUFSIZE)
+    feeder = None
+    feed_errors = []
+    if stdin is subprocess.PIPE:
+        def feed():
+            try:
+                shutil.copyfileobj(fileobj, process.stdin, TAR_BUFSIZE)
+                process.stdin.close()
+            except BrokenPipeError:
+                # the decompressor exited early. it's return code says why.
+                pass
+            except Exception as err:
+                feed_errors.append(err)
+                process.kill()
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+    stopped_early = True
+    try:
+        yield process.stdout
+        # tarfile stops reading at the end of archive marker, and
+        # extract_nested stops as soon as it's found it's member, so output
+        # may be left unread. only the return code of a process that was read
+        # to the end means anything (the rest would fail with SIGPIPE).
+        stopped_early = bool(process.stdout.read(1))
+    finally:
+        if stopped_early:
+            process.kill()
+        process.stdout.close()
+        if feeder:
+            feeder.join()
+        process.wait()
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode and not stopped_early:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def _check_members(path: str, names: Iterable[str]):
+    """raises InSanityError if any of |names| would land outside of |path|"""
+    abs_path = os.path.abspath(path)
+    for name in names:
+        target = os.path.abspath(os.path.join(path, name))
+        if os.path.commonpath((abs_path, target)) != abs_path:
+            raise tegrity.err.InSanityError(
+                f"Attempted Path Traversal in archive: {name}")
+
+
+def _check_link(path: str, member: tarfile.TarInfo):
+    """
+    raises InSanityError if link |member| points outside of |path|. Hard
+    links name another member. Relative symlinks must resolve inside |path|.
+    Absolute symlinks are left alone, since in a rootfs they point inside it
+    once it's chrooted into (nothing is extracted through them, see
+    _check_parent).
+    """
+    if member.islnk():
+        _check_members(path, (member.linkname,))
+    elif member.issym() and not os.path.isabs(member.linkname):
+        _check_members(path, (os.path.join(
+            os.path.dirname(member.name), member.linkname),))
+
+
+def _check_parent(real_path: str, target: str, checked: set):
+    """
+    raises InSanityError if the folder |target| is extracted into resolves
+    (through symlinks already extracted) outside of |real_path|, the
+    realpath of the extraction path. Folders already |checked| are skipped.
+    """
+    parent = os.path.dirname(target)
+    if parent in checked:
+        return
+    real_parent = os.path.realpath(parent)
+    if os.path.commonpath((real_path, real_parent)) != real_path:
+        raise tegrity.err.InSanityError(
+            f"Attempted extraction through a symlink to {real_parent}")
+    checked.add(parent)
+
+
+def _strip(name: str, components: int) -> str:
+    """:returns: |name| without it's first |components| path components"""
+    # slicing after the n-th '/' avoids building a list for every member
+    start = 0
+    for _ in range(components):
+        start = name.find('/', start) + 1
+        if not start:
+            return ''
+    return name[start:]
+
+
+def _extract_stream(archive: tarfile.TarFile,
+                    path: str,
+                    strip_components=0,
+                    merge=False) -> List[tarfile.TarInfo]:
+    """
+    Extracts a tarfile opened in stream mode (eg. 'r|*') to |path| one member
+    at a time, refusing any member that would land outside of |path|, links
+    pointing outside of it, and members under symlinks that lead outside.
+
+    :param strip_components: see extract()
+    :param merge: see extract()
+
+    :returns: the list of extracted members
+    """
+    member_list = []
+    directories = []
+    extract_member = archive.extract
+    real_path = os.path.realpath(path)
+    # folders known not to resolve outside of |path| (until a symlink is
+    # extracted, which could replace one)
+    checked = set()
+    for member in archive:
+        if strip_components:
+            member.name = _strip(member.name, strip_components)
+            if not member.name.strip('/'):
+                continue
+            if member.islnk():
+                member.linkname = _strip(member.linkname, strip_components)
+        _check_members(path, (member.name,))
+        _check_link(path, member)
+        target = os.path.join(path, member.name)
+        _check_parent(real_path, target, checked)
+        if member.issym():
+            checked.clear()
+        if merge:
+            # unknown names make tarfile fall back to these ids
+            member.uid, member.gid = os.getuid(), os.getgid()
+            member.uname = member.gname = ''
+            if os.path.isdir(target) and not os.path.islink(target):
+                if member.isdir():
+                    member_list.append(member)
+                    continue
+            else:
+                # replaced rather than overwritten, in case it's in use
+                # (ETXTBSY) or hard linked elsewhere
+                try:
+                    os.unlink(target)
+                except FileNotFoundError:
+                    pass
+        if member.isdir():
+            # like extractall, directory attributes are set at the end in case
+            # a directory is read only
+            directories.append(member)
+            extract_member(member, path, set_attrs=False)
+        else:
+            extract_member(member, path)
+        member_list.append(member)
+    directories.sort(key=lambda d: d.name, reverse=True)
+    for member in directories:
+        dirpath = os.path.join(path, member.name)
+        archive.chown(member, dirpath, False)
+        archive.utime(member, dirpath)
+        archive.chmod(member, dirpath)
+    return member_list
+
+
+def extract_nested(file_or_url: str,
+                   member: str,
+                   path: str,
+                   hexdigest: Optional[str] = None,
+                   hasher: Optional[Callable] = None,
+                   **kwargs) -> List[tarfile.TarInfo]:
+    """
+    (Downloads) and extracts a tarball nested inside another tarball to path.
+    The nested tarball is streamed out of the outer one and never written to
+    disk, nor is the rest of the outer tarball extracted.
+
+    :param file_or_url: file or url of the outer tarball
+    :param member: path of the nested tarball inside the outer tarball
+    :param path: path to extract the nested tarball to
+    :param kwargs: passed to download()
+    :param hexdigest: Expected hash of the outer tarball from hasher
+    :param hasher: hasher to use (eg. "hashlib.sha512")
+
+    :returns: the nested tarball's member list
+    :raises: FileNotFoundError (with |member| as filename) if |member| is not
+    found in the outer tarball.
+    """
+    # see extract()
+    hash_as_extracted = not os.path.exists(path)
+    with _fetched(file_or_url, hexdigest, hasher,
+                  verify_local=not hash_as_extracted,
+                  **kwargs) as local, _removed_on_error(path):
+        logger.debug(f"Extracting {member} from {local} to {path}")
+        member = os.path.normpath(member)
+        with _open_hashed(local, *_local_verify_args(
+                file_or_url, hexdigest, hasher, hash_as_extracted)) as f, \
+                _open_tar_stream(f, local) as outer:
+            for outer_member in outer:
+                if os.path.normpath(outer_member.name) != member:
+                    continue
+                # the nested tarball needs the large buffer too, or it's read
+                # out of the outer one 10 KiB at a time
+                with _open_tar_stream(outer.extractfile(outer_member),
+                                      outer_member.name) as inner:
+                    return _extract_stream(inner, path)
+    raise FileNotFoundError(
+        errno.ENOENT, f"not found in {file_or_url}", member)
 
 
 # noinspection PyUnresolvedReferences
+def _hash_into(f: BinaryIO, hasher, chunk_size: int):
+    """updates |hasher| with the rest of unbuffered file |f|"""
+    # read into one buffer instead of allocating a new bytes for every chunk.
+    # anonymous mmaps are page aligned, which suits both the kernel's copy
+    # out and the hash's (OpenSSL's, with SHA extensions if it has them).
+    buffer = mmap.mmap(-1, chunk_size)
+    view = memoryview(buffer)
+    with buffer, view:
+        size = f.readinto(buffer)
+        while size:
+            hasher.update(view[:size])
+            size = f.readinto(buffer)
+
+
 def verify(file: Union[str, os.PathLike],
            hexdigest: str,
            hasher: Callable,
-           chunk_size=2 ** 25):
-    """verifies a downloaded file using hashlib"""
-    logger.debug(f"Using {hasher.name} to verify archive.")
-    logger.debug(f"Expecting hex digest: {hexdigest}")
-    with open(file, 'rb') as f:
-        chunk = f.read(chunk_size)
-        while chunk:
-            hasher.update(chunk)
-            chunk = f.read(chunk_size)
+           chunk_size=CHUNK_SIZE):
+    """
+    verifies a downloaded file using hashlib
+
+    :arg file: the file to verify
+    :arg hexdigest: Expected hash from hasher
+    :arg hasher: hasher to use (eg. "hashlib.sha512")
+    :param chunk_size: size (in bytes) of the reusable read buffer
+    """
+    hasher = hasher()
+    with open(file, 'rb', buffering=0) as f:
+        stat = os.fstat(f.fileno())
+        if _is_verified(stat, hasher.name, hexdigest):
+            logger.debug(f"{file} already verified. Not hashing it again.")
+            return
+        logger.debug(f"Using {hasher.name} to verify archive.")
+        logger.debug(f"Expecting hex digest: {hexdigest}")
+        if FILE_DIGEST:
+            # hashlib's own loop (3.11+), which releases the gil for large
+            # updates and skips the per-chunk python overhead below
+            FILE_DIGEST(f, lambda: hasher)
+        else:
+            _hash_into(f, hasher, chunk_size)
     if hasher.hexdigest() != hexdigest:
         raise tegrity.err.InTegrityError(
             f"Hash verification failed for {file}.  "
             f"expected: {hexdigest} but got {hasher.hexdigest()}"
         )
+    _mark_verified(stat, hasher.name, hexdigest)
@@ -52,9 +52,9 @@ _utils_logger = logging.getLogger('utils')  # fakes utils module logging,
 
 # most of these should probably not be overriden, but you can if you have good
 # reason to.
-SCRIPT_NAME = os.path.basename(__file__)
-THIS_SCRIPT_ABSPATH = os.path.abspath(__file__)
-THIS_DIR = os.path.dirname(THIS_SCRIPT_ABSPATH)
+THIS_SCRIPT_ABSPATH = __file__ if os.path.isabs(__file__) \
+    else os.path.join(os.getcwd(), __file__)
+THIS_DIR, SCRIPT_NAME = os.path.split(THIS_SCRIPT_ABSPATH)
 SCRIPT_FOLDER_NAME = 'tegrity_fb'
 SCRIPT_ABS_TARGET_PATH = os.path.join('/etc', SCRIPT_FOLDER_NAME, SCRIPT_NAME)
 SERVICE_NAME = 'tegrity-fb.service'
@@ -75,6 +75,9 @@ SCRIPT_MODE = 0o755
 # something sensitive.
 LOG_MODE = 0o600
 
+# the filled out default template, populated on first use by _fill_template
+_DEFAULT_UNIT_TEXT = None
+
 
 def _fill_template(
         template: str = SERVICE_TEMPLATE_FILE,
@@ -90,6 +93,10 @@ def _fill_template(
     >>> _fill_template(template='{foo}', parameters={'foo':'bar'})
     "bar"
     """
+    global _DEFAULT_UNIT_TEXT
+    defaults = template == SERVICE_TEMPLATE_FILE and not parameters
+    if defaults and _DEFAULT_UNIT_TEXT is not None:
+        return _DEFAULT_UNIT_TEXT
     if not parameters:
         parameters = SERVICE_TEMPLATE_DEFAULTS
     logger.debug(f"filling out template with parameters: {parameters}")
@@ -97,7 +104,7 @@ def _fill_template(
         with open(os.path.join(THIS_DIR, SERVICE_TEMPLATE_FILE)) as f:
             template = f.read()
     try:
-        return template.format(**parameters)
+        unit_text = template.format(**parameters)
     except KeyError as err:
         raise KeyError(
             f"Malformed template file or parameters. "
@@ -105,6 +112,9 @@ def _fill_template(
             f"help on Nvidia's devtalk forum, or modify the "
             f"_fill_template function in {SCRIPT_NAME} yourself."
         ) from err
+    if defaults:
+        _DEFAULT_UNIT_TEXT = unit_text
+    return unit_text
 
 
 def _install_service(rootfs, service_name=SERVICE_NAME):
@@ -137,10 +147,45 @@ def _mkdir(path, mode):
     return os.mkdir(path, mode)
 
 
+def _copy_data(fsrc, fdst, length=2**30):
+    """copies the contents of open file |fsrc| to |fdst| in-kernel if possible
+    (os.copy_file_range, then os.sendfile), otherwise with a 1 MiB buffer"""
+    for name in ('copy_file_range', 'sendfile'):
+        copy_range = getattr(os, name, None)
+        if copy_range is None:
+            continue
+        try:
+            if name == 'copy_file_range':
+                while copy_range(fsrc.fileno(), fdst.fileno(), length):
+                    pass
+            else:
+                while copy_range(fdst.fileno(), fsrc.fileno(), None, length):
+                    pass
+            return
+        except OSError:
+            # not supported between these files (eg. EXDEV on older kernels
+            # or EINVAL on some filesystems), start over
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, 2**20)
+
+
 def _copy(src, dest, **kwargs):
-    """wraps shutil.copy() and logs to debug level"""
+    """wraps shutil.copy() and logs to debug level. The data is copied
+    in-kernel (see _copy_data) instead of through a small userspace buffer."""
     _utils_logger.debug(f"copying {src} to {dest}")
-    return shutil.copy(src, dest, **kwargs)
+    if kwargs:
+        return shutil.copy(src, dest, **kwargs)
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        # like shutil.copy, rather than truncating |src|
+        raise shutil.SameFileError(f"{src} and {dest} are the same file")
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        _copy_data(fsrc, fdst)
+    os.chmod(dest, os.stat(src).st_mode & 0o7777)
+    return dest
 
 
 def _remove(path):
@@ -197,7 +242,7 @@ def init_first_boot_folder(rootfs, overwrite=False, interactive=False):
                 shutil.rmtree(tegrity_fb)
             return init_first_boot_folder(rootfs)
     _chmod(tegrity_fb, SCRIPT_MODE)
-    dest = os.path.join(tegrity_fb, os.path.basename(__file__))
+    dest = os.path.join(tegrity_fb, SCRIPT_NAME)
     _copy(THIS_SCRIPT_ABSPATH, dest)
     _chmod(dest, SCRIPT_MODE)
     return tegrity_fb
@@ -254,20 +299,29 @@ def run_scripts(folder=None, cleanup=False):
                 log = os.path.join(root, f"{script}.log")
                 log_fd = os.open(
                     log, os.O_CREAT | os.O_WRONLY | os.O_APPEND, LOG_MODE)
+                # lines are collected and logged once the script is done, so
+                # the logger isn't hit once per line of output
+                out_lines = []
+                err_lines = []
                 with open(log_fd, 'a') as log:
 # we're muxing the streams here
 # https://docs.python.org/3/library/itertools.html#itertools.zip_longest
                     for stdout, stderr in itertools.zip_longest(
                             process.stdout, process.stderr):
-                        stdout = stdout.decode()
-                        log.write(stdout)
-                        logger.debug(stdout)
+                        if stdout:
+                            stdout = stdout.decode()
+                            log.write(stdout)
+                            out_lines.append(stdout.rstrip())
                         if stderr:
                             stderr = stderr.decode()
                             log.write(stderr)
-                            logger.error(
-                                f"{os.path.basename(script)}:{stderr.rstrip()}")
+                            err_lines.append(stderr.rstrip())
                 process.wait(timeout=10)
+                if out_lines:
+                    logger.debug('\n'.join(out_lines))
+                if err_lines:
+                    logger.error(
+                        f"{os.path.basename(script)}:" + '\n'.join(err_lines))
                 if cleanup and not process.returncode:
                     _remove(script)
                 if process.returncode:
@@ -21,7 +21,6 @@
 import logging
 import os
 import time
-import math
 
 import tegrity
 
@@ -30,7 +29,6 @@ JETSON_DISK_IMAGE_CREATOR = ("tools", "jetson-disk-image-creator.sh")
 
 logger = logging.getLogger(__name__)
 
-
 # todo: change this when adding Xavier support
 def make_image(l4t_path: os.PathLike,
                out: os.PathLike = None,):
@@ -55,8 +53,9 @@ def make_image(l4t_path: os.PathLike,
         rootfs_size = tegrity.utils.estimate_size(
             os.path.join(l4t_path, 'rootfs'))
         # add 1GB for other partitions, updates, some guaranteed free space,
-        # and round up to nearest power of two sd card size:
-        sd_size = 2 ** (math.ceil(math.log(rootfs_size + 1, 2)))
+        # and round up to nearest power of two sd card size. The smallest
+        # power of two >= n is 1 << (n - 1).bit_length(), with n = size + 1:
+        sd_size = 1 << rootfs_size.bit_length()
         logger.info(f"a {sd_size} GB size SD card will be required.")
 
         old_script = os.path.join(l4t_path, NANO_SD_CARD_SCRIPT)
@@ -18,23 +18,35 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
 import hashlib
 import logging
 import os
+import shutil
+import subprocess
 import tempfile
 
 import tegrity
 
 from typing import (
     Iterable,
+    Optional,
 )
 
 from tegrity.settings import (
+    CCACHE,
+    CCACHE_DIR,
+    KBUILD_CACHE,
+    KBUILD_CACHE_MAX_SIZE,
+    KERNEL_SOURCE_CACHE,
+    KERNEL_SOURCE_CACHE_MAX_SIZE,
     KERNEL_TARBALL_PATH,
     KERNEL_PATH,
     DEFAULT_LOCALVERSION,
     NANO_TX1_KERNEL_URL,
     NANO_TX1_KERNEL_SHA512,
+    LBZIP2,
+    PBZIP2,
 )
 
 logger = logging.getLogger(__name__)
@@ -42,21 +54,94 @@ logger = logging.getLogger(__name__)
 # this should never need to change on Tegra, but if you want to use this code
 # elsewhere, it might be useful (tells make which architecture ot target)
 ARCH = 'arm64'
+# a guess at the peak memory usage of a single compile job, used to limit -j
+MEMORY_PER_JOB = 2 * 2**30
+# a tmpfs for the temporary rootfs, used if it has at least TMPFS_MIN_FREE
+TMPFS = '/dev/shm'
+TMPFS_MIN_FREE = 2 * 2**30
 
 
-def _get_source(tmp, public_sources, public_sources_sha):
-    """called from main, separated for testing purposes"""
-    source_path = os.path.join(tmp, 'sources')
-    logger.debug(f"source path: {source_path}")
-    os.mkdir(source_path, mode=0o755)
-    download_source(
-        public_sources, source_path,
-        hasher=hashlib.sha512,
-        hexdigest=public_sources_sha, )
+def _kernel_out_key(public_sources_sha, load_kconfig, *args) -> Optional[str]:
+    """
+    :returns: a key for a persistent kernel_out folder, from the sources, the
+    kconfig loaded (if any) and any other |args| that affect the build, or
+    None if the sources aren't verified (so there is nothing to key them by)
+    """
+    if not public_sources_sha:
+        return
+    hasher = hashlib.sha256()
+    for arg in (public_sources_sha, *args):
+        hasher.update(f"{arg}\0".encode())
+    if load_kconfig:
+        with open(load_kconfig, 'rb') as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def _tmpfs_dir() -> Optional[str]:
+    """:returns: TMPFS if it exists and has TMPFS_MIN_FREE bytes free,
+    otherwise None (the default temporary directory)"""
+    try:
+        if shutil.disk_usage(TMPFS).free >= TMPFS_MIN_FREE:
+            return TMPFS
+    except OSError:
+        pass
+    logger.debug(f"{TMPFS} not available or too small, not using it")
+
+
+def _source_cache_dir(public_sources_sha):
+    """:returns: the persistent source folder for a public_sources sha512"""
+    return os.path.join(KERNEL_SOURCE_CACHE, public_sources_sha)
+
+
+def _get_source(tmp, public_sources, public_sources_sha) -> str:
+    """
+    called from main, separated for testing purposes
+
+    If |public_sources_sha| is supplied, the sources are extracted once to a
+    persistent cache folder keyed by it and reused on subsequent builds.
+    Otherwise they are extracted under |tmp|.
+
+    :returns: the kernel source path
+    """
+    if public_sources_sha:
+        source_path = _source_cache_dir(public_sources_sha)
+    else:
+        source_path = os.path.join(tmp, 'sources')
     kernel_source_path = os.path.join(source_path, *KERNEL_PATH)
+    if public_sources_sha and tegrity.cache.trusted(source_path) \
+            and os.path.isdir(kernel_source_path) \
+            and os.listdir(kernel_source_path):
+        logger.info(f"Using cached kernel source at {kernel_source_path}")
+        # it's mtime is it's last use (see tegrity.cache.prune)
+        os.utime(source_path)
+    elif public_sources_sha:
+        # extract alongside the cache and rename into place when complete so
+        # an interrupted extraction is never mistaken for a cached source.
+        os.makedirs(KERNEL_SOURCE_CACHE, 0o755, exist_ok=True)
+        # (.part, so tegrity.cache.prune leaves it alone)
+        staging = tempfile.mkdtemp(suffix='.part', dir=KERNEL_SOURCE_CACHE)
+        try:
+            os.chmod(staging, 0o755)
+            download_source(
+                public_sources, staging,
+                hasher=hashlib.sha512,
+                hexdigest=public_sources_sha, )
+            # an incomplete or untrusted cache entry, for example
+            tegrity.cache.discard(source_path)
+            os.rename(staging, source_path)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        tegrity.cache.prune(KERNEL_SOURCE_CACHE_MAX_SIZE, source_path,
+                            KERNEL_SOURCE_CACHE)
+    else:
+        logger.debug(f"source path: {source_path}")
+        os.mkdir(source_path, mode=0o755)
+        download_source(public_sources, source_path)
     if not os.path.isdir(kernel_source_path):
         raise RuntimeError("Could not find kernel source.")
-    os.chdir(kernel_source_path)
+    return kernel_source_path
 
 
 def download_source(public_sources: str, source_dir,
@@ -73,17 +158,14 @@ def download_source(public_sources: str, source_dir,
     public_sources.tbz2
     """
     logger.info(f"Obtaining kernel sources from {public_sources}.")
-    with tempfile.TemporaryDirectory() as tmp:
-        tegrity.download.extract(
-            public_sources, tmp, hasher=hasher, hexdigest=hexdigest)
-        kernel_tarball = os.path.join(
-            tmp, *KERNEL_TARBALL_PATH)
-        try:
-            tegrity.download.extract(kernel_tarball, source_dir)
-        except FileNotFoundError as err:
-            raise FileNotFoundError(
-                f"{err.filename} not found in tarball. Bad url?"
-            )
+    try:
+        tegrity.download.extract_nested(
+            public_sources, os.path.join(*KERNEL_TARBALL_PATH), source_dir,
+            hasher=hasher, hexdigest=hexdigest)
+    except FileNotFoundError as err:
+        raise FileNotFoundError(
+            f"{err.filename} not found in tarball. Bad url?"
+        ) from err
 
 
 # this is following the instructions from:
@@ -91,7 +173,7 @@ def download_source(public_sources: str, source_dir,
 def build(l4t_path, public_sources,
           # todo: xconfig=None,
           arch=ARCH,
-          cross_prefix=tegrity.toolchain.get_cross_prefix(),
+          cross_prefix=None,
           load_kconfig=None,
           localversion=None,
           menuconfig=None,
@@ -102,12 +184,15 @@ def build(l4t_path, public_sources,
 
     logger.info("Preparing to build kernel")
 
-    # set some envs
-    os.environ['CROSS_COMPILE'] = cross_prefix
+    # set some envs (for make only, the global os.environ is left alone)
+    if not cross_prefix:
+        cross_prefix = tegrity.toolchain.get_cross_prefix()
     logger.debug(f'CROSS_COMPILE: {cross_prefix}')
     localversion = localversion if localversion else DEFAULT_LOCALVERSION
-    os.environ['LOCALVERSION'] = localversion
     logger.debug(f'LOCALVERSION: {localversion}')
+    env = dict(os.environ,
+               CROSS_COMPILE=cross_prefix,
+               LOCALVERSION=localversion)
 
     # set up some initial paths
     logger.debug(f"Linux_for_Tegra path: {l4t_path}")
@@ -115,113 +200,203 @@ def build(l4t_path, public_sources,
     logger.debug(f"L4T kernel path: {l4t_kernel_path}")
 
     # create a temporary folder that self destructs at the end of the context.
-    with tempfile.TemporaryDirectory() as tmp:
+    # the temporary rootfs goes on tmpfs if there's room, since the modules
+    # are only written there to be read back and archived.
+    with tempfile.TemporaryDirectory() as tmp, \
+            tempfile.TemporaryDirectory(dir=_tmpfs_dir()) as rootfs_tmp:
 
         # set up a temporary rootfs folder instead of a real one just to create
         # the kernel_supplements which will be installed by apply_binaries.sh
-        rootfs = os.path.join(tmp, 'rootfs')
+        rootfs = os.path.join(rootfs_tmp, 'rootfs')
         logger.debug(f"creating temporary rootfs at: {rootfs}")
         os.makedirs(rootfs, 0o755)
 
         # Obtaining the Kernel Sources
-        _get_source(tmp, public_sources, public_sources_sha512)
+        kernel_source_path = _get_source(
+            tmp, public_sources, public_sources_sha512)
 
         # Building the kernel
 
-        # 1. set kernel out path
-        kernel_out = os.path.join(tmp, "kernel_out")
-
-        # 2.5 set common make arguments
-        make_common = [f"ARCH={arch}", f"O={kernel_out}"]
+        # 1. set kernel out path. this is kept between builds of the same
+        # verified source and config (so make only rebuilds what changed)
+        # unless the config is being edited interactively.
+        kernel_out_key = None if menuconfig else _kernel_out_key(
+            public_sources_sha512, load_kconfig,
+            arch, cross_prefix, localversion)
+        if kernel_out_key:
+            kernel_out = os.path.join(KBUILD_CACHE, kernel_out_key)
+            if os.path.lexists(kernel_out) and \
+                    not tegrity.cache.trusted(kernel_out):
+                tegrity.cache.discard(kernel_out)
+        else:
+            kernel_out = os.path.join(tmp, "kernel_out")
+
+        # 2.5 set common make arguments (-C instead of changing the working
+        # directory of the whole process)
+        make_common = ["-C", kernel_source_path,
+                       f"ARCH={arch}", f"O={kernel_out}"]
+        if CCACHE:
+            # paths under the source are rewritten relative to the (temporary)
+            # build folder, or uncached sources would make every object a miss
+            # (a CCACHE_DIR already set by the user is respected)
+            env.setdefault('CCACHE_DIR', CCACHE_DIR)
+            env['CCACHE_BASEDIR'] = os.path.dirname(kernel_source_path)
+            logger.info(f"Using ccache with cache at {env['CCACHE_DIR']}")
+            make_common.append(f"CC={CCACHE} {cross_prefix}gcc")
 
         # 3. Create the initial config
-        config(make_common, kernel_out, load_kconfig)
-        os.chdir(kernel_out)
+        if kernel_out_key and os.path.isfile(
+                os.path.join(kernel_out, '.config')):
+            logger.info(f"Reusing configured kernel build at {kernel_out}")
+            # it's mtime is it's last use (see tegrity.cache.prune)
+            os.utime(kernel_out)
+        else:
+            config(make_common, kernel_out, load_kconfig, env=env)
 
         # 3.5 Customize initial configuration interactively (optional)
         if menuconfig:
-            make_menuconfig(make_common)
+            make_menuconfig(make_common, env=env)
 
         # 4 Build the kernel and all modules
-        make_kernel(make_common)
-
-        # 5 Backup and replace old kernel with new kernel
-        replace_kernel(kernel_out, l4t_kernel_path)
-
-        # 6 Replace dtb folder with dts folder
-        replace_dtb(kernel_out, l4t_kernel_path)
-
-        # 7 Install kernel modules
-        make_modules_install(make_common, rootfs)
-
-        # 8 Archive modules
-        archive_modules(rootfs, module_archive, l4t_kernel_path)
-
-        # 8.5 Archive config
-        archive_kconfig(kernel_out, save_kconfig)
+        if CCACHE:
+            _log_ccache_stats(env)
+        make_kernel(make_common, env=env)
+        if CCACHE:
+            _log_ccache_stats(env)
+
+        # steps 5 through 8.5 write to disjoint paths, so they run
+        # concurrently, except archive_modules, which needs modules_install
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            futures = [
+                # 5 Backup and replace old kernel with new kernel
+                executor.submit(replace_kernel, kernel_out, l4t_kernel_path,
+                                keep_build=bool(kernel_out_key)),
+                # 6 Replace dtb folder with dts folder
+                executor.submit(replace_dtb, kernel_out, l4t_kernel_path,
+                                keep_build=bool(kernel_out_key)),
+                # 8.5 Archive config
+                executor.submit(archive_kconfig, kernel_out, save_kconfig),
+            ]
+
+            # 7 Install kernel modules
+            executor.submit(
+                make_modules_install, make_common, rootfs, env=env).result()
+
+            # 8 Archive modules
+            futures.append(executor.submit(
+                archive_modules, rootfs, module_archive, l4t_kernel_path))
+
+            for future in futures:
+                future.result()
+
+        if kernel_out_key:
+            tegrity.cache.prune(KBUILD_CACHE_MAX_SIZE, kernel_out,
+                                KBUILD_CACHE)
 
     # todo: support for external kernel modules:
 
 
 def config(make_args, kernel_out,
            load_kconfig=None,
-           kernel_source_path=None):
+           env=None):
     logger.info("Configuring kernel")
-    os.mkdir(kernel_out, 0o755)
+    os.makedirs(kernel_out, 0o755, exist_ok=True)
+    # whatever the umask, or it won't be trusted next time (see tegrity.cache)
+    os.chmod(kernel_out, 0o755)
     if load_kconfig:
-        config_filename = os.path.join(kernel_source_path, '.config')
+        # O= builds read the config from the output folder, and the source
+        # tree (which may be cached) must be left clean
+        config_filename = os.path.join(kernel_out, '.config')
         tegrity.utils.copy(load_kconfig, config_filename)
     else:
         # use the default config
         tegrity.utils.run(
-            ("make", *make_args, "tegra_defconfig"),
+            ("make", *make_args, "tegra_defconfig"), env=env,
         ).check_returncode()
 
 
-def make_menuconfig(make_args: Iterable):
+def make_menuconfig(make_args: Iterable, env=None):
     tegrity.utils.run(
-        ("make", *make_args, "menuconfig"),
+        ("make", *make_args, "menuconfig"), env=env,
     ).check_returncode()
 
 
-def make_kernel(make_args: Iterable):
-    jobs = os.cpu_count()
-    logger.info(f"Building the kernel using all available cores ({jobs}).")
+def _max_jobs() -> int:
+    """
+    :returns: the number of cores, clamped so every job can have
+    MEMORY_PER_JOB of ram (so the host doesn't grind to a halt swapping)
+    """
+    jobs = os.cpu_count() or 1
+    try:
+        ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return jobs
+    return max(1, min(jobs, ram // MEMORY_PER_JOB))
+
+
+def make_kernel(make_args: Iterable, env=None):
+    jobs = _max_jobs()
+    logger.info(f"Building the kernel using {jobs} jobs.")
+    # -l stops make from starting new jobs while the host is already loaded
     tegrity.utils.run(
-        ("make", *make_args, f"-j{jobs}")
+        ("make", *make_args, f"-j{jobs}", f"-l{jobs}"), env=env,
     ).check_returncode()
 
 
-def replace_kernel(kernel_out, l4t_kernel_path):
+def replace_kernel(kernel_out, l4t_kernel_path, keep_build=False):
+    """:param keep_build: copy the new kernel rather than moving it out of
+    |kernel_out| (so it isn't rebuilt next time)"""
     logger.info("Replacing old kernel")
     new_kernel = os.path.join(
         kernel_out, "arch", "arm64", "boot", "Image")
     if not os.path.isfile(new_kernel):
         raise RuntimeError(f"Can't find new kernel at {new_kernel}.")
     old_kernel = os.path.join(l4t_kernel_path, "Image")
-    if os.path.exists(old_kernel):
+    try:
         tegrity.utils.backup(old_kernel)
-    tegrity.utils.move(new_kernel, old_kernel)
+    except FileNotFoundError:
+        logger.warning(f"Old kernel not found at {old_kernel}")
+    if keep_build:
+        tegrity.utils.copy(new_kernel, old_kernel)
+    else:
+        tegrity.utils.move(new_kernel, old_kernel)
 
 
-def replace_dtb(kernel_out, l4t_kernel_path):
+def replace_dtb(kernel_out, l4t_kernel_path, keep_build=False):
+    """:param keep_build: copy the new dtb folder rather than moving it out of
+    |kernel_out| (so it isn't rebuilt next time)"""
     logger.info("Replacing old dtb folder.")
     new_dtb = os.path.join(
         kernel_out, "arch", "arm64", "boot", "dts")
     if not os.path.isdir(new_dtb):
         raise RuntimeError("Can't find new dtb folder.")
     old_dtb = os.path.join(l4t_kernel_path, "dtb")
-    if os.path.exists(old_dtb):
+    try:
         tegrity.utils.backup(old_dtb)
-    tegrity.utils.move(new_dtb, old_dtb)
+    except FileNotFoundError:
+        logger.warning(f"Old dtb folder not found at {old_dtb}")
+    if keep_build:
+        shutil.copytree(new_dtb, old_dtb, copy_function=tegrity.utils.copy)
+    else:
+        tegrity.utils.move(new_dtb, old_dtb)
+
 
+def _log_ccache_stats(env=None):
+    """logs ccache hit/miss statistics at debug level (if enabled, since it
+    runs ccache -s)"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    stats = tegrity.utils.run((CCACHE, '-s'), env=env,
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    logger.debug(f"ccache stats:\n{stats.stdout}")
 
-def make_modules_install(make_args: Iterable, rootfs):
+
+def make_modules_install(make_args: Iterable, rootfs, env=None):
     logger.info("Installing kernel modules to temporary rootfs.")
     tegrity.utils.run(
         ("make", *make_args, "modules_install",
-         f"INSTALL_MOD_PATH={rootfs}")
-    )
+         f"INSTALL_MOD_PATH={rootfs}"), env=env,
+    ).check_returncode()
 
 
 def archive_modules(rootfs, module_archive=None, l4t_kernel_path=None):
@@ -231,22 +406,31 @@ def archive_modules(rootfs, module_archive=None, l4t_kernel_path=None):
                 l4t_kernel_path, "kernel_supplements.tbz2")
         else:
             raise ValueError("module_archive or l4t_kernel_path required")
-    if os.path.isfile(module_archive):
-        logger.info("Backing up old kernel supplements")
+    try:
         tegrity.utils.backup(module_archive)
-    os.chdir(rootfs)
+    except FileNotFoundError:
+        logger.debug(f"No old kernel supplements at {module_archive}")
     logger.info(f"Archiving modules as {module_archive}")
+    # kernel modules carry no xattrs, acls, or selinux labels, so skip the
+    # per-file lookups, and compress on all cores if pbzip2 or lbzip2 is
+    # installed (the output is still .tbz2, as apply_binaries.sh expects)
+    bzip2 = PBZIP2 or LBZIP2
     tegrity.utils.run(
-        ("tar", "--owner", "root", "-cjf", module_archive, "lib/modules"),
+        ("tar", "--owner", "root", "--no-xattrs", "--no-acls", "--no-selinux",
+         f"--use-compress-program={bzip2}" if bzip2 else "--bzip2",
+         "-cf", module_archive, "-C", rootfs, "lib/modules"),
     ).check_returncode()
 
 
 def archive_kconfig(kernel_out_folder, config_out):
     if config_out:
         used_config = os.path.join(kernel_out_folder, '.config')
-        if os.path.exists(config_out):
+        try:
             tegrity.utils.backup(config_out)
-        tegrity.utils.move(used_config, config_out)
+        except FileNotFoundError:
+            pass
+        # copied, not moved, since make may still read it (modules_install)
+        tegrity.utils.copy(used_config, config_out)
 
 
 def cli_main():
@@ -25,10 +25,10 @@
 
 import os
 import logging
-import subprocess
 import shutil
 
 from typing import (
+    TYPE_CHECKING,
     Dict,
     Iterable,
     List,
@@ -38,12 +38,42 @@ from typing import (
     Union,
 )
 
+if TYPE_CHECKING:
+    # only used for annotations, so not imported at runtime
+    import subprocess
+
 import tegrity
 
 logger = logging.getLogger(__name__)
 
 # default arch (used to find qemu static binary)
 ARCH = 'aarch64'
+# where scripts are copied to, as seen from inside the chroot
+TMP_IN_CHROOT = '/tmp'
+
+
+_RO_OPTIONS = ('ro', 'nosuid', 'nodev', 'noexec', 'relatime')
+_BIND_RO_OPTIONS = ('bind', 'ro')
+# (source, target path in rootfs, type, options) for default_mount_kwargs
+_MOUNT_TABLE = (
+    ('sysfs', ('sys',), 'sysfs', _RO_OPTIONS),
+    ('proc', ('proc',), 'proc', _RO_OPTIONS),
+    ('/dev', ('dev',), None, _BIND_RO_OPTIONS),
+    ('devpts', ('dev', 'pts'), 'devpts', (
+        "rw",
+        "nosuid",
+        "noexec",
+        "relatime",
+        "gid=5",
+        "mode=620",
+        "ptmxmode=000",
+    )),
+    ('/etc/resolv.conf', ('run', 'resolvconf', 'resolv.conf'), None,
+     _BIND_RO_OPTIONS),
+    # normally noexec and some other stuff might go here, but we'll use /tmp
+    # inside the rootfs for scripts, so we need to execute from it
+    ('tmpfs', ('tmp',), 'tmpfs', None),
+)
 
 
 def default_mount_kwargs(rootfs: str) -> List[Dict[str, Union[List[str], str]]]:
@@ -67,58 +97,12 @@ def default_mount_kwargs(rootfs: str) -> List[Dict[str, Union[List[str], str]]]:
 
     :param rootfs: path to the rootfs
     """
-    list_of_kwargs = [
-        # /sys
-        {
-            'source': 'sysfs',
-            'target': os.path.join(rootfs, 'sys'),
-            'type_': 'sysfs',
-            'options': ['ro', 'nosuid', 'nodev', 'noexec', 'relatime'],
-        },
-        # /proc
-        {
-            'source': 'proc',
-            'target': os.path.join(rootfs, 'proc'),
-            'type_': 'proc',
-            'options': ['ro', 'nosuid', 'nodev', 'noexec', 'relatime'],
-        },
-        # /dev
-        {
-            'source': '/dev',
-            'target': os.path.join(rootfs, 'dev'),
-            'options': ['bind', 'ro'],
-        },
-        # /dev/pts
-        {
-            'source': 'devpts',
-            'target': os.path.join(rootfs, 'dev', 'pts'),
-            'type_': 'devpts',
-            'options': [
-                "rw",
-                "nosuid",
-                "noexec",
-                "relatime",
-                "gid=5",
-                "mode=620",
-                "ptmxmode=000",
-            ]
-        },
-        # resolv.conf
-        {
-            'source': '/etc/resolv.conf',
-            'target': os.path.join(rootfs, 'run', 'resolvconf', 'resolv.conf'),
-            'options': ['bind', 'ro']
-        },
-        # /tmp
-        {
-            'source': 'tmpfs',
-            'target': os.path.join(rootfs, 'tmp'),
-            'type_': 'tmpfs',
-            # normally noexec and some other stuff might go here, but we'll use
-            # /tmp inside the rootfs for scripts, so we need to execute from it
-        },
-    ]
-    return list_of_kwargs
+    return [{
+        'source': source,
+        'target': os.path.join(rootfs, *target),
+        'type_': type_,
+        'options': list(options) if options else None,
+    } for source, target, type_, options in _MOUNT_TABLE]
 
 
 class QemuRunner(object):
@@ -175,6 +159,9 @@ class QemuRunner(object):
             if ':' not in userspec or '-' in userspec:
                 raise ValueError("Userspec format invalid. see chroot manual")
         self.userspec = userspec
+        # the chroot command for the default userspec, built once
+        self._default_base_command = ('chroot',) + (
+            (f'--userspec={userspec}',) if userspec else ()) + (self.rootfs,)
         self.tmp = os.path.join(rootfs, 'tmp')
         self._qemu_copied = False
         self._mounted = []  # unmounted on __exit__
@@ -229,13 +216,9 @@ class QemuRunner(object):
                 logger.error(f"removing {script} failed", err)
 
     def _base_command(self, userspec: Optional[str] = None) -> List[str]:
-        command = ['chroot']
-        if userspec:
-            command.append(f'--userspec={userspec}')
-        elif self.userspec:
-            command.append(f'--userspec={self.userspec}')
-        command.append(self.rootfs)
-        return command
+        if not userspec or userspec == self.userspec:
+            return list(self._default_base_command)
+        return ['chroot', f'--userspec={userspec}', self.rootfs]
 
     def enter_chroot(self, userspec: Optional[str] = None):
         tegrity.utils.run(
@@ -243,18 +226,18 @@ class QemuRunner(object):
         ).check_returncode()
 
     def run_cmd(self, command: Iterable, userspec=None,
-                **kwargs) -> subprocess.CompletedProcess:
+                **kwargs) -> 'subprocess.CompletedProcess':
         cmd = self._base_command(userspec=userspec)
         cmd.extend(command)
-        return tegrity.utils.run(command, **kwargs)
+        return tegrity.utils.run(cmd, **kwargs)
 
     def run_script(self, script, *options,
                    userspec: Optional[str] = None,
-                   ) -> subprocess.CompletedProcess:
+                   ) -> 'subprocess.CompletedProcess':
         dest = os.path.join(self.tmp, script)
         tegrity.utils.copy(script, dest)
         self._scripts.append(dest)
-        dest_in_chroot = os.path.join('/tmp', script)
+        dest_in_chroot = os.path.join(TMP_IN_CHROOT, script)
         return self.run_cmd((dest_in_chroot, *options), userspec=userspec)
 
 
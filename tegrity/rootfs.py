@@ -21,21 +21,27 @@
 import hashlib
 import logging
 import os
-import sqlite3
-import pathlib
+import shutil
 
 from typing import (
+    TYPE_CHECKING,
     Callable,
+    Optional,
 )
 
+if TYPE_CHECKING:
+    # only used for annotations, so not imported at runtime
+    import sqlite3
+
 import tegrity
 
 from tegrity.settings import (
-    BOARD_ID_TO_SOC,
+    BOARD_ID_TO_SOURCES_LIST,
     L4T_ROOTFS_SHA512,
     L4T_ROOTFS_URL,
-    NV_SOURCES_LIST,
-    NV_SOURCES_LIST_TEMPLATE,
+    NV_SOURCES_LIST_REL,
+    ROOTFS_STAGING,
+    ROOTFS_STAGING_MAX_SIZE,
     UBUNTU_BASE_SHA_256,
     UBUNTU_BASE_URL,
 
@@ -48,21 +54,20 @@ logger = logging.getLogger(__name__)
 # new sha512 sums can be generated with python's hashlib module or
 # the sha512sum command
 
-# todo: cache downloads in ~/.tegrity to avoid hammering Nvidia's servers
-
 def modify_sources(rootfs, board_id):
-    sources_list = os.path.join(rootfs, *NV_SOURCES_LIST)
+    sources_list = os.path.join(rootfs, NV_SOURCES_LIST_REL)
+    # looked up before the open, so an unknown board doesn't truncate the file
+    text = BOARD_ID_TO_SOURCES_LIST[board_id]
     logger.debug(f"overwriting {sources_list}")
     try:
         with open(sources_list, 'w') as sources_list:
-            soc = BOARD_ID_TO_SOC[board_id]
-            sources_list.write(NV_SOURCES_LIST_TEMPLATE.format(soc=soc))
+            sources_list.write(text)
     except FileNotFoundError as err:
         raise FileNotFoundError(
             f"could not find {sources_list} in rootfs") from err
 
 
-def get_path(bundle: sqlite3.Row):
+def get_path(bundle: 'sqlite3.Row'):
     """:returns: the path to the rootfs of the |bundle|"""
     l4t_path = tegrity.db.get_l4t_path(bundle)
     return tegrity.utils.join_and_check(l4t_path, "rootfs")
@@ -80,12 +85,49 @@ def ubuntu_base_reset(rootfs: str, source: str = None, sha256: str = None):
                  f"and verifying using sha256: {sha256}")
     if os.path.exists(rootfs):
         tegrity.utils.backup(rootfs)
+        hasher = hashlib.sha256 if sha256 else None
         tegrity.download.extract(
-            source, rootfs,
-            hasher=hashlib.sha256 if sha256 else None,
+            tegrity.cache.fetch(source, sha256, hasher), rootfs,
+            hasher=hasher,
             hexdigest=sha256)
 
 
+def _extract_staged(tarball: str, rootfs: str,
+                    hasher: Optional[Callable] = None,
+                    hexdigest: Optional[str] = None):
+    """
+    Extracts a verified |tarball| once to ROOTFS_STAGING/<hexdigest> and
+    copies that to |rootfs| with tegrity.utils.clone_tree, so resetting to the
+    same tarball again skips the decompression. Tarballs without a
+    |hexdigest| are just extracted to |rootfs|.
+    """
+    if not (hasher and hexdigest):
+        tegrity.download.extract(tarball, rootfs)
+        return
+    stage = os.path.join(ROOTFS_STAGING, hexdigest)
+    if tegrity.cache.trusted(stage):
+        logger.info(f"Using previously extracted {tarball} at {stage}")
+        # it's mtime is it's last use (see tegrity.cache.prune)
+        os.utime(stage)
+    else:
+        os.makedirs(ROOTFS_STAGING, 0o755, exist_ok=True)
+        # extracted next to the stage and renamed, so it's always complete
+        partial = f"{stage}.part"
+        shutil.rmtree(partial, ignore_errors=True)
+        tegrity.download.extract(
+            tarball, partial, hasher=hasher, hexdigest=hexdigest)
+        # nobody else may write it, or it won't be trusted (see above)
+        os.chmod(partial, os.stat(partial).st_mode & ~0o022)
+        # (untrusted, if it's there)
+        tegrity.cache.discard(stage)
+        os.rename(partial, stage)
+        tegrity.cache.prune(ROOTFS_STAGING_MAX_SIZE, stage, ROOTFS_STAGING)
+    # a copy (cloned where the filesystem can), not hard links, since the
+    # rootfs is modified in place later (eg. modify_sources) and that must
+    # not change the stage.
+    tegrity.utils.clone_tree(stage, rootfs)
+
+
 def reset(rootfs: str,
           source: str = None,
           source_hasher: Callable = None,
@@ -117,45 +159,46 @@ def reset(rootfs: str,
                 logger.warning(f"{source} is a http url. changing to https")
                 source = f"https{source[4:]}"
             tegrity.utils.backup(rootfs)
-            tegrity.download.extract(
-                source, rootfs,
-                hasher=source_hasher,
-                hexdigest=source_hexdigest,)
+            _extract_staged(
+                tegrity.cache.fetch(source, source_hexdigest, source_hasher),
+                rootfs, source_hasher, source_hexdigest)
         elif os.path.isfile(source):
             tegrity.utils.backup(rootfs)
-            tegrity.download.extract(
-                source, rootfs,
-                hasher=source_hasher,
-                hexdigest=source_hexdigest,)
+            _extract_staged(source, rootfs, source_hasher, source_hexdigest)
         elif os.path.isdir(source):
             if not os.path.exists(os.path.join(source, 'etc')) and \
                     os.path.exists(os.path.join(source, 'bin')):
                 raise tegrity.err.InSanityError(
                     "/etc/ or /bin/ not found. This doesn't look like a rootfs")
             tegrity.utils.backup(rootfs)
-            tegrity.utils.copy(source, rootfs)
+            tegrity.utils.clone_tree(source, rootfs)
         return
 
     tegrity.utils.backup(rootfs)
-    tegrity.download.extract(
-        L4T_ROOTFS_URL, rootfs,
-        hasher=hashlib.sha512,
-        hexdigest=L4T_ROOTFS_SHA512,
-    )
+    _extract_staged(
+        tegrity.cache.fetch(L4T_ROOTFS_URL, L4T_ROOTFS_SHA512, hashlib.sha512),
+        rootfs, hashlib.sha512, L4T_ROOTFS_SHA512)
 
 
 def apply_binaries(rootfs: os.PathLike, target_overlay=False):
-    """runs the apply_binaries.sh script within a Linux_for_Tegra folder"""
-    rootfs = pathlib.Path(os.path.abspath(rootfs))
-    l4t_path = rootfs.parent
-    if not os.path.isdir(l4t_path):
-        raise FileNotFoundError(f"{l4t_path} not found")
-    rootfs = os.path.join(l4t_path, 'rootfs')
-    if not os.path.isdir(rootfs):
+    """runs the apply_binaries.sh script within a Linux_for_Tegra folder on
+    the |rootfs| in it"""
+    rootfs = os.path.abspath(os.fspath(rootfs))
+    l4t_path, rootfs_name = os.path.split(rootfs)
+    # one directory read rather than a stat per check
+    try:
+        with os.scandir(l4t_path) as it:
+            entries = {e.name: e for e in it}
+    except (FileNotFoundError, NotADirectoryError) as err:
+        raise FileNotFoundError(f"{l4t_path} not found") from err
+    if rootfs_name not in entries or not entries[rootfs_name].is_dir():
         raise FileNotFoundError(f"{rootfs} not found")
-    script = tegrity.utils.join_and_check(l4t_path, 'apply_binaries.sh')
-    if not os.path.isfile(script):
-        raise FileNotFoundError(f"{script} not found")
+    script = os.path.join(l4t_path, 'apply_binaries.sh')
+    if 'apply_binaries.sh' not in entries or \
+            not entries['apply_binaries.sh'].is_file():
+        raise FileNotFoundError(
+            f"apply_binaries.sh not found in {l4t_path}. "
+            f"{tegrity.err.BUNDLE_REINSTALL}")
     command = [script, ]
     if target_overlay:
         command.append('-t')
@@ -189,7 +232,8 @@ def main(rootfs,
         try:
             modify_sources(
                 rootfs,
-                tegrity.db.autodetect_hwid(pathlib.Path(rootfs).parent))
+                tegrity.db.autodetect_hwid(
+                    os.path.dirname(os.path.abspath(rootfs))))
         except Exception as err:
             raise RuntimeError(
                 "Failed to modify apt sources on rootfs.") from err
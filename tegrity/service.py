@@ -20,13 +20,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import functools
 import logging
 import os
 
 import tegrity
 
+from typing import (
+    Iterable,
+    Tuple,
+)
+
 __all__ = [
-    'install'
+    'install',
+    'install_many',
 ]
 
 logger = logging.getLogger(__name__)
@@ -39,6 +47,12 @@ DEFAULT_BEFORE = 'default.target'
 DEFAULT_WANTED_BY = 'default.target'
 DEFAULT_BINDIR = ('usr', 'local', 'exe')
 DEFAULT_UNIT_PATH = ('lib', 'systemd', 'system')
+# where systemctl enable links units to from their WantedBy= targets
+SYSTEM_CONFIG_PATH = ('etc', 'systemd', 'system')
+# the above, joined once
+DEFAULT_BINDIR_REL = os.path.join(*DEFAULT_BINDIR)
+DEFAULT_UNIT_PATH_REL = os.path.join(*DEFAULT_UNIT_PATH)
+SYSTEM_CONFIG_PATH_REL = os.path.join(*SYSTEM_CONFIG_PATH)
 
 
 def is_enabled(service_name, rootfs) -> bool:
@@ -51,6 +65,33 @@ def is_enabled(service_name, rootfs) -> bool:
     return True
 
 
+def _wants_links(service_name, rootfs, wanted_by) -> list:
+    """:returns: the .wants symlinks systemctl enable would make for the
+    |service_name| on the |rootfs| for each target in |wanted_by|"""
+    config_path = os.path.join(rootfs, SYSTEM_CONFIG_PATH_REL)
+    return [os.path.join(config_path, f"{target}.wants", service_name)
+            for target in wanted_by.split()]
+
+
+def _is_enabled_fast(service_name, rootfs, wanted_by=DEFAULT_WANTED_BY) -> bool:
+    """like is_enabled, but only checks for the .wants symlinks on the rootfs
+    rather than running systemctl"""
+    return all(os.path.islink(link)
+               for link in _wants_links(service_name, rootfs, wanted_by))
+
+
+def _enable_fast(service_name, rootfs, wanted_by=DEFAULT_WANTED_BY):
+    """enables a |service_name| installed in DEFAULT_UNIT_PATH on a |rootfs|
+    by making the same .wants symlinks systemctl enable does"""
+    target = f'/{DEFAULT_UNIT_PATH_REL}/{service_name}'
+    for link in _wants_links(service_name, rootfs, wanted_by):
+        if os.path.islink(link):
+            continue
+        os.makedirs(os.path.dirname(link), 0o755, exist_ok=True)
+        logger.debug(f"linking {link} to {target}")
+        os.symlink(target, link)
+
+
 def is_active(service_name) -> bool:
     """returns True if a service is running on the host. False otherwise."""
     retcode = tegrity.utils.run(
@@ -77,6 +118,28 @@ def stop(service_name):
     ).check_returncode()
 
 
+def _check_rootfs(rootfs: str) -> Tuple[str, str]:
+    """:returns: the bindir and unit path on a |rootfs|
+    :raises: FileNotFoundError if either is missing"""
+    bindir = os.path.join(rootfs, DEFAULT_BINDIR_REL)
+    if not os.path.isdir(bindir):
+        raise FileNotFoundError(f"{bindir} not found. Wrong rootfs path?")
+    unitpath = os.path.join(rootfs, DEFAULT_UNIT_PATH_REL)
+    if not os.path.isdir(unitpath):
+        raise FileNotFoundError(
+            f"{unitpath} not found. Does this rootfs use systemd?")
+    return bindir, unitpath
+
+
+@functools.lru_cache(maxsize=1)
+def _read_template() -> str:
+    """:returns: the contents of DEFAULT_TEMPLATE (read once, it's installed
+    with the package)"""
+    logger.debug(f"reading template: {DEFAULT_TEMPLATE}")
+    with open(DEFAULT_TEMPLATE) as template_file:
+        return template_file.read()
+
+
 def install(executable: str, rootfs: str,
             after: str = DEFAULT_AFTER,
             before: str = DEFAULT_BEFORE,
@@ -85,48 +148,71 @@ def install(executable: str, rootfs: str,
     # check all files and paths exist (yeah, this isn't pythonic, but whatever)
     if not os.path.isfile(executable):
         raise FileNotFoundError(f"{executable} not found.")
-    bindir = os.path.join(rootfs, *DEFAULT_BINDIR)
-    if not os.path.isdir(bindir):
-        raise FileNotFoundError(f"{bindir} not found. Wrong rootfs path?")
-    unitpath = os.path.join(rootfs, *DEFAULT_UNIT_PATH)
-    if not os.path.isdir(unitpath):
-        raise FileNotFoundError(
-            f"{unitpath} not found. Does this rootfs use systemd?")
+    bindir, unitpath = _check_rootfs(rootfs)
+    _install_one(executable, rootfs, bindir, unitpath, _read_template(),
+                 after, before, wanted_by)
+
+
+def install_many(executables: Iterable[str], rootfs: str,
+                 after: str = DEFAULT_AFTER,
+                 before: str = DEFAULT_BEFORE,
+                 wanted_by: str = DEFAULT_WANTED_BY):
+    """
+    Installs several |executables| as simple systemd services on a rootfs,
+    each like install() with the same |after|, |before| and |wanted_by|.
+
+    Everything is checked before anything is installed. The template is read
+    once and the services are installed from a thread pool, since it's all
+    file i/o.
+    """
+    executables = list(executables)
+    missing = [e for e in executables if not os.path.isfile(e)]
+    if missing:
+        raise FileNotFoundError(f"{', '.join(missing)} not found.")
+    bindir, unitpath = _check_rootfs(rootfs)
+    template = _read_template()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [executor.submit(
+            _install_one, executable, rootfs, bindir, unitpath, template,
+            after, before, wanted_by) for executable in executables]
+        # re-raise the first failure, if any
+        for future in futures:
+            future.result()
+
+
+def _install_one(executable: str, rootfs: str, bindir: str, unitpath: str,
+                 template: str, after: str, before: str, wanted_by: str):
+    exec_name = os.path.basename(executable)
+    logger.debug(f"executable basename: {exec_name}")
 
     # copy the file to the bindir and make it executable
-    exec_dest = os.path.join(bindir, executable)
+    exec_dest = os.path.join(bindir, exec_name)
     tegrity.utils.copy(executable, exec_dest)
     tegrity.utils.chmod(exec_dest, 0o755)
 
     # configure executable paths and service paths
-    exec_name = os.path.basename(executable)
-    logger.debug(f"executable basename: {exec_name}")
-    execstart = os.path.join('/', *DEFAULT_BINDIR, exec_name)
+    execstart = f'/{DEFAULT_BINDIR_REL}/{exec_name}'
     logger.debug(f"absolute path on rootfs (execstart): {execstart}")
     service_basename = f"{os.path.splitext(exec_name)[0]}.service"
     service_filename = os.path.join(unitpath, service_basename)
 
     # fill in the template and write it out
-    logger.debug(f"filling in template: {DEFAULT_TEMPLATE}")
-    with open(DEFAULT_TEMPLATE) as template_file:
-        unit = template_file.read().format(
-            after=after,
-            before=before,
-            exec_name=exec_name,
-            execstart=execstart,
-            wanted_by=wanted_by,
-        )
+    unit = template.format(
+        after=after,
+        before=before,
+        exec_name=exec_name,
+        execstart=execstart,
+        wanted_by=wanted_by,
+    )
     logger.debug(f"writing filled out template to {service_filename}")
     with open(service_filename, 'w') as service_file:
         service_file.write(unit)
 
-    if is_enabled(service_basename, rootfs):
+    if _is_enabled_fast(service_basename, rootfs, wanted_by):
         logger.info("service seems to already be enabled.")
     else:
         logger.info(f"enabling {service_basename} on rootfs")
-        tegrity.utils.run(
-            ('systemctl', f'--root={rootfs}', 'enable', service_basename)
-        ).check_returncode()
+        _enable_fast(service_basename, rootfs, wanted_by)
 
 
 def cli_main():
@@ -11,10 +11,31 @@ CONFIG_PATH_MODE = 0o700
 DEFAULT_CONFIG_PATH = os.path.join(os.path.expanduser("~"), f".tegrity")
 
 # for download.py
-# todo: implement, since python bzip is really slow
+# parallel bzip2, used to decompress tarballs if installed, since the python
+# bz2 module is really slow (pbzip2, below, is used if this isn't found)
 LBZIP2 = shutil.which('lbzip2')
+# xz and parallel gzip, used the same way for .xz and .gz tarballs (eg. the
+# toolchain) if installed
+XZ = shutil.which('xz')
+PIGZ = shutil.which('pigz')
+# records of local files already verified (by device, inode, size, and
+# times), so they aren't hashed again every time they're used
+VERIFIED_CACHE = os.path.join(DEFAULT_CONFIG_PATH, 'verified.json')
+
+# for cache.py
+# verified downloads (rootfs and toolchain tarballs) are kept here
+CACHE_PATH = os.path.join(DEFAULT_CONFIG_PATH, 'cache')
+# least recently used downloads are removed beyond this many bytes
+CACHE_MAX_SIZE = 20 * 10**9
 
 # for kernel.py
+# parallel bzip2, used to compress kernel_supplements.tbz2 if installed
+# (lbzip2, above, is used if this isn't found)
+PBZIP2 = shutil.which('pbzip2')
+# compiler cache, used to wrap the cross compiler if installed. the cache
+# itself is kept in the config path so it survives between builds.
+CCACHE = shutil.which('ccache')
+CCACHE_DIR = os.path.join(DEFAULT_CONFIG_PATH, 'ccache')
 DEFAULT_LOCALVERSION = '-tegrity'
 NANO_TX1_KERNEL_URL = "https://developer.nvidia.com/embedded/dlc/r32-3-1_Release_v1.0/Sources/T210/public_sources.tbz2"
 NANO_TX1_KERNEL_SHA512 = "f9729758ff44f9b18ec78a3e99634a8cac1ca165f40cda825bc18f6fdd0b088baac5a5c0868167a420993b3a7aed78bc9a43ecd7dc5bba2c75ca20c6635573a6"
@@ -24,17 +45,36 @@ XAVIER_TX2_KERNEL_SHA512 = "78e6d3cc67dcbdf27cb21f4cbbabb7a5b89ca813f2aaeb60a06e
 KERNEL_TARBALL_PATH = ('Linux_for_Tegra', 'source', 'public', 'kernel_src.tbz2',)
 # the path to the kernel inside kernel_src.tbz2
 KERNEL_PATH = ('kernel', 'kernel-4.9')
+# extracted sources are kept here, in folders named by public_sources sha512
+KERNEL_SOURCE_CACHE = os.path.join(DEFAULT_CONFIG_PATH, 'sources')
+# least recently used sources are removed beyond this many bytes
+KERNEL_SOURCE_CACHE_MAX_SIZE = 10 * 10**9
+# kernel build (O=) folders are kept here, named by a hash of what they're
+# built from (sources, config, cross prefix...), so rebuilds are incremental
+KBUILD_CACHE = os.path.join(DEFAULT_CONFIG_PATH, 'kbuild')
+# least recently used build folders are removed beyond this many bytes
+KBUILD_CACHE_MAX_SIZE = 20 * 10**9
 
 # for rootfs.py
+# rootfs tarballs are extracted here once, in folders named by their hexdigest
+ROOTFS_STAGING = os.path.join(DEFAULT_CONFIG_PATH, 'unpacked')
+# least recently used extracted tarballs are removed beyond this many bytes
+ROOTFS_STAGING_MAX_SIZE = 20 * 10**9
 # urls, shas, and supported model numbers for their rootfs
 L4T_ROOTFS_URL = "https://developer.nvidia.com/embedded/r32-2-3_Release_v1.0/t210ref_release_aarch64/Tegra_Linux_Sample-Root-Filesystem_R32.2.3_aarch64.tbz2"
 L4T_ROOTFS_SHA512 = "15075b90d2e6f981e40e7fdd5b02fc1e3bbf89876a6604e61b77771519bf3970308ee921bb39957158153ba8597a31b504f5d77c205c0a0c2d3b483aee9f0d4f"
 UBUNTU_BASE_URL = "http://cdimage.ubuntu.com/ubuntu-base/releases/18.04.3/release/ubuntu-base-18.04-base-arm64.tar.gz"
 UBUNTU_BASE_SHA_256 = "9193fd5f648e12c2102326ee6fdc69ac59c490fac3eb050758cee01927612021"
 NV_SOURCES_LIST = ('etc', 'apt', 'sources.list.d', "nvidia-l4t-apt-source.list")
+NV_SOURCES_LIST_REL = os.path.join(*NV_SOURCES_LIST)
 NV_SOURCES_LIST_TEMPLATE = """deb https://repo.download.nvidia.com/jetson/common r32 main
 deb https://repo.download.nvidia.com/jetson/{soc} r32 main"""
 # this is a mapping between board id and appropriate SOC to fill in the repo url
 BOARD_ID_TO_SOC = {
     tegrity.db.NANO_DEV_ID: 't210'
+}
+# the above, rendered once
+BOARD_ID_TO_SOURCES_LIST = {
+    board_id: NV_SOURCES_LIST_TEMPLATE.format(soc=soc)
+    for board_id, soc in BOARD_ID_TO_SOC.items()
 }
\ No newline at end of file
@@ -18,14 +18,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import functools
 import hashlib
 import logging
 import os
 import platform
+import re
 import shutil
-import subprocess
-import tempfile
-import urllib.request
+import sys
 
 import tegrity
 
@@ -44,6 +45,9 @@ ARCH = 'aarch64'
 
 DEFAULT_TARBALL_INSTALL_PREFIX = '/usr/local'
 
+# where ensure() can install a missing toolchain from, in it's prompt's order
+TOOLCHAIN_SOURCES = ('apt', 'tarball')
+
 if platform.machine() == "i386":
     URL = "https://releases.linaro.org/components/toolchain/binaries/7.3-2018.05/aarch64-linux-gnu/gcc-linaro-7.3.1-2018.05-i686_aarch64-linux-gnu.tar.xz"
     MD5 = "https://releases.linaro.org/components/toolchain/binaries/7.3-2018.05/aarch64-linux-gnu/gcc-linaro-7.3.1-2018.05-i686_aarch64-linux-gnu.tar.xz.asc"
@@ -53,21 +57,89 @@ elif platform.machine() == "x86_64":
 else:
     raise RuntimeError(
         "Unsupported architecture. Only x86 and x86-64 currently supported.")
+# preferred over MD5 if the mirror has it (sha256sum format)
+SHA256 = f"{URL}.sha256"
+# seconds to wait on a checksum request, so a stalled mirror fails the
+# install instead of hanging it
+CHECKSUM_TIMEOUT = 30
 
 
 def get_cross_prefix() -> Optional[str]:
-    """:returns: the cross prefix for the toolchain in path"""
+    """:returns: the cross prefix for the toolchain in path (cached per PATH,
+    since it's used for argparse and function defaults. the install_*
+    functions clear it)"""
+    return _find_cross_prefix(os.environ.get('PATH'))
+
+
+@functools.lru_cache(maxsize=4)
+def _find_cross_prefix(path: Optional[str]) -> Optional[str]:
+    """:returns: the cross prefix for the toolchain in |path|"""
     logger.debug(f"Checking for cross compiler...")
-    gcc = shutil.which(f"aarch64-linux-gnu-gcc")
+    gcc = shutil.which(f"aarch64-linux-gnu-gcc", path=path)
     if not gcc:
         return
     logger.debug(f"Found gcc cross compiler at {gcc}")
     cross_prefix = os.path.join(
-        os.path.dirname(shutil.which(f"aarch64-linux-gnu-gcc")),
+        os.path.dirname(gcc),
         f"aarch64-linux-gnu-")
     return cross_prefix
 
 
+def _fetch_sha256() -> Optional[str]:
+    """:returns: the toolchain tarball's sha256sum from SHA256, or None if the
+    mirror doesn't have one or it can't be fetched (the md5sum is used then)"""
+    # imported here (and below) since urllib.request pulls in ssl, http and
+    # email, which --check doesn't need
+    import urllib.error
+    import urllib.request
+    logger.debug(f"Fetching checksum from {SHA256}")
+    try:
+        with urllib.request.urlopen(
+                SHA256, timeout=CHECKSUM_TIMEOUT) as response:
+            hexdigest = _parse_sha256(response.read(4096))
+    except urllib.error.HTTPError as err:
+        if err.code == 404:
+            logger.debug(f"{SHA256} not found.")
+        else:
+            logger.warning(f"Could not fetch {SHA256} because: {err}")
+        return
+    except OSError as err:
+        # URLError, socket.timeout, connection resets...
+        logger.warning(f"Could not fetch {SHA256} because: {err}")
+        return
+    if not hexdigest:
+        logger.warning(f"{SHA256} doesn't contain a sha256sum. Ignoring it.")
+        return
+    logger.debug(f"got sha256sum: {hexdigest}")
+    return hexdigest
+
+
+def _parse_sha256(body: bytes) -> Optional[str]:
+    """
+    :returns: the sha256sum at the start of |body| (sha256sum output, with or
+    without a filename after it), or None if there isn't one (eg. a mirror
+    serving an html page instead of a 404)
+
+    >>> _parse_sha256(b'ab' * 32 + b'  gcc-linaro.tar.xz\\n')
+    'abababababababababababababababababababababababababababababababab'
+    >>> _parse_sha256(b'<!DOCTYPE html><html><head><title>Not Found</title>')
+    >>> _parse_sha256(b'')
+    """
+    fields = body.decode(errors='replace').split(maxsplit=1)
+    if fields and re.fullmatch(r'[0-9a-fA-F]{64}', fields[0]):
+        return fields[0]
+
+
+def _fetch_md5() -> str:
+    """:returns: the toolchain tarball's md5sum from the .asc at MD5"""
+    import urllib.request
+    logger.debug(f"Fetching checksum from {MD5}")
+    with urllib.request.urlopen(MD5, timeout=CHECKSUM_TIMEOUT) as response:
+        hexdigest = response.read(32).decode()
+    logger.debug(f"got md5sum: {hexdigest}")
+    return hexdigest
+
+
 # noinspection PyUnresolvedReferences
 def install_from_tarball(
         install_path: os.PathLike = DEFAULT_TARBALL_INSTALL_PREFIX) -> str:
@@ -77,6 +149,7 @@ def install_from_tarball(
 
     >>> logging.basicConfig(level=logging.DEBUG)
     >>> logger.debug("Testing install_from_tarball")
+    >>> import tempfile
     >>> with tempfile.TemporaryDirectory() as tmp:
     ...     cross_prefix = install_from_tarball(tmp)
     ...     bindir = os.path.dirname(cross_prefix)
@@ -85,42 +158,40 @@ def install_from_tarball(
     """
     logger.debug(f"Install path set to: {install_path}")
 
-    # get the md5 to verify archive tegrity
-    with urllib.request.urlopen(MD5) as response:
-        logger.debug(f"Fetching checksum from {MD5}")
-        hexdigest = response.read(32).decode()
-        logger.debug(f"got md5sum: {hexdigest}")
-
-    with tempfile.TemporaryDirectory() as extract_dir:
-        logger.info("Downloading and verifying toolchain...")
-        member_list = tegrity.download.extract(
-            URL, extract_dir,
-            hasher=hashlib.md5,
-            hexdigest=hexdigest,
-        )
-        # todo: this is a sloppy assumption that the tarball will always be this
-        #  format, fix so it's more flexible for possible future changes.:
-        if member_list[0].isdir():
-            top_level_folder = member_list[0].name
+    logger.info("Downloading and verifying toolchain...")
+    # both checksums are requested at once. sha256 is used if the mirror has
+    # it, otherwise the md5 to verify archive tegrity is left to arrive while
+    # the (much larger) tarball downloads.
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        sha256 = executor.submit(_fetch_sha256)
+        md5 = executor.submit(_fetch_md5)
+        if sha256.result():
+            hasher, hexdigest = hashlib.sha256, sha256.result()
         else:
-            raise RuntimeError(
-                f"Could not find top level folder in tarball. "
-                f"{tegrity.err.TOOLCHAIN_TRY_APT}"
-            )
-        rsync_source = os.path.join(extract_dir, top_level_folder)
-        logger.debug(f"rsync source: {rsync_source}")
-        if not os.path.isdir(rsync_source):
-            raise RuntimeError(
-                f"Could not find extracted top level folder."
-                f"{tegrity.err.TOOLCHAIN_TRY_APT}"
-            )
-
-        logger.info(f"Installing toolchain:")
-        subprocess.run(
-            ("rsync", "-a", "--info=progress2", f"{rsync_source}/", install_path)
-        ).check_returncode()
-
-    return os.path.join(install_path, "bin", "aarch64-linux-gnu-")
+            hasher, hexdigest = hashlib.md5, md5.result
+        tarball = tegrity.cache.fetch(URL, hexdigest, hasher)
+        if callable(hexdigest):
+            hexdigest = hexdigest()
+    # verified before anything is extracted, since it's extracted straight to
+    # the install path (this is a no-op if it was just downloaded)
+    tegrity.download.verify(tarball, hexdigest, hasher)
+
+    # todo: this is a sloppy assumption that the tarball will always have a
+    #  single top level folder, fix so it's more flexible for possible future
+    #  changes.:
+    logger.info(f"Installing toolchain to {install_path}")
+    member_list = tegrity.download.extract(
+        tarball, install_path, strip_components=1, merge=True)
+    logger.info(f"Installed {len(member_list)} toolchain files")
+    cross_prefix = os.path.join(install_path, "bin", "aarch64-linux-gnu-")
+    if not os.path.isfile(f"{cross_prefix}gcc"):
+        raise RuntimeError(
+            f"Could not find {cross_prefix}gcc after extracting toolchain. "
+            f"{tegrity.err.TOOLCHAIN_TRY_APT}"
+        )
+
+    _find_cross_prefix.cache_clear()
+    return cross_prefix
 
 
 def install_from_apt():
@@ -128,13 +199,35 @@ def install_from_apt():
     Installs the Ubuntu/debian repository version of gcc
     """
     tegrity.apt.install(("gcc-aarch64-linux-gnu",))
+    _find_cross_prefix.cache_clear()
     return "/usr/bin/aarch64-linux-gnu-"
 
 
-def ensure(cross_prefix=None) -> str:
+def _getch() -> str:
+    """reads a single keypress from the terminal (no Enter needed). ctrl+c
+    still interrupts."""
+    try:
+        import termios
+        import tty
+    except ImportError:
+        return input()[:1]
+    fd = sys.stdin.fileno()
+    old = termios.tcgetattr(fd)
+    try:
+        tty.setcbreak(fd)
+        return sys.stdin.read(1)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+
+def ensure(cross_prefix=None, source: Optional[str] = None) -> str:
     """ensures toolchain is installed interactively and returns cross prefix
 
     :param cross_prefix: overrides auto-detection, still checks if gcc exists
+    :param source: one of TOOLCHAIN_SOURCES to install a missing toolchain
+    from without asking. If None, the user is asked if stdin is a terminal,
+    otherwise (eg. in scripts and CI) 'apt' is used, rather than blocking on
+    input() forever.
 
     >>> ensure()
     '/usr/local/bin/aarch64-linux-gnu-'
@@ -143,36 +236,45 @@ def ensure(cross_prefix=None) -> str:
     cross_prefix = cross_prefix if cross_prefix else get_cross_prefix()
     # this should point to gcc:
     gcc = f"{cross_prefix}gcc"
-    if cross_prefix and os.path.isfile(gcc):
+    if cross_prefix and os.access(gcc, os.X_OK):
         return cross_prefix
-    else:
+    if source is None and not sys.stdin.isatty():
+        logger.info("aarch64-linux-gnu toolchain not found and stdin is not "
+                    "a terminal, so installing it with apt.")
+        source = 'apt'
+    if source is None:
         logger.error(
             "aarch64-linux-gnu toolchain not found. Do you wish to install "
             "one, either from system apt repositories or the recommended from "
             "releases.linaro.org?"
         )
-        choice = 0
-        while not 1 <= choice <= 2:
-            try:
-                choice = int(input(
-                    "choose 1 (apt), 2 (releases.linaro.org), or ctrl+c to exit")
-                )
-            except ValueError:
-                logger.error("invalid choice, try again")
-                pass
-        if choice == 1:
-            return tegrity.toolchain.install_from_apt()
-        elif choice == 2:
-            return tegrity.toolchain.install_from_tarball()
+        print("choose 1 (apt), 2 (releases.linaro.org), or ctrl+c to exit",
+              end=' ', flush=True)
+        key = _getch()
+        while key not in ('1', '2'):
+            logger.error("invalid choice, try again")
+            key = _getch()
+        print(key)
+        source = TOOLCHAIN_SOURCES[int(key) - 1]
+    if source == 'apt':
+        return tegrity.toolchain.install_from_apt()
+    elif source == 'tarball':
+        return tegrity.toolchain.install_from_tarball()
+    raise ValueError(
+        f"toolchain source must be one of {', '.join(TOOLCHAIN_SOURCES)}")
 
 
 def main(check=None,
          install_tarball=None,
          prefix=None,
-         install_apt=None):
-    if not (check or install_tarball or install_apt):
+         install_apt=None,
+         ensure_installed=None,
+         toolchain_source=None):
+    if not (check or install_tarball or install_apt or ensure_installed):
         raise ValueError("Nothing to do.")
     cross_prefix = get_cross_prefix()
+    if ensure_installed:
+        cross_prefix = ensure(cross_prefix, toolchain_source)
     if check:
         if not cross_prefix:
             raise FileNotFoundError("Toolchain not found.")
@@ -204,6 +306,13 @@ def cli_main():
         '--install-apt', help="install distro bundled toolchain (not "
         "recommended, but it appears to work)",
         action='store_true'),
+    ap.add_argument(
+        '--ensure', help="install a toolchain only if one isn't found",
+        action='store_true', dest='ensure_installed'),
+    ap.add_argument(
+        '--toolchain-source', help="where --ensure installs from. If not "
+        "given, asks, or uses apt if stdin is not a terminal",
+        choices=TOOLCHAIN_SOURCES),
 
     # add --log-file and --verbose
     main(**tegrity.cli.cli_common(ap))
@@ -18,19 +18,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import functools
 import getpass
 import logging
 import os
 import shutil
 import subprocess
+import sys
 import time
 
 from typing import (
     Any,
     Callable,
+    Dict,
     Iterable,
+    List,
     Optional,
     Sequence,
+    Tuple,
 )
 
 import tegrity
@@ -50,6 +59,7 @@ from tegrity.firstboot import (
 __all__ = [
     'chmod',
     'chooser',
+    'clone_tree',
     'copy',
     'ensure_sudo',
     'estimate_size',
@@ -66,11 +76,11 @@ __all__ = [
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
 def real_username() -> str:
-    """:returns" the real username running the script"""
-    return os.environ['SUDO_USER'] \
-        if "SUDO_USER" in os.environ \
-        else getpass.getuser()
+    """:returns" the real username running the script (cached, it can't
+    change during a run)"""
+    return os.environ.get('SUDO_USER') or getpass.getuser()
 
 
 def chooser(list_of_things: Sequence, name_of_things: str,
@@ -84,6 +94,8 @@ def chooser(list_of_things: Sequence, name_of_things: str,
     :param name_of_things: plural name of the thing
     :param formatter: formatter to convert the thing to a string
 
+    The choice may be typed as it's number or it's (tab completed) name.
+
     :returns: chosen item from the list
     """
     if len(list_of_things) == 1:
@@ -94,23 +106,60 @@ def chooser(list_of_things: Sequence, name_of_things: str,
         thing = list_of_things[0]
         logger.debug(f"Only one {name_of_things} found: {thing}")
         return thing if not formatter else formatter(thing)
-    choice = None
-    while choice not in range(len(list_of_things)):
-        print(f"Please choose from the following {name_of_things}:")
-        for number, thing in enumerate(list_of_things):
-            print(number, thing if not formatter else formatter(thing))
-        try:
-            choice = int(input(f"Choice (0-{len(list_of_things) - 1})"))
-        except ValueError:
-            logger.error("Choice must be a number.")
-    return list_of_things[choice]
+    # formatted once, since the formatter may be slow
+    names = [str(thing if not formatter else formatter(thing))
+             for thing in list_of_things]
+    print(f"Please choose from the following {name_of_things}:")
+    for number, name in enumerate(names):
+        print(number, name)
+    with _completing(names):
+        while True:
+            answer = input(f"Choice (0-{len(names) - 1})").strip()
+            if answer in names:
+                return list_of_things[names.index(answer)]
+            try:
+                choice = int(answer)
+            except ValueError:
+                logger.error("Choice must be a number or a name.")
+                continue
+            if choice in range(len(names)):
+                return list_of_things[choice]
+            logger.error(f"Choice must be from 0 to {len(names) - 1}.")
+
+
+@contextlib.contextmanager
+def _completing(names: Sequence[str]):
+    """tab completes input() from |names| in the context, if readline is
+    available"""
+    try:
+        import readline
+    except ImportError:
+        yield
+        return
+
+    def complete(text, state):
+        matches = [n for n in names if n.startswith(text)]
+        return matches[state] if state < len(matches) else None
+
+    old_completer = readline.get_completer()
+    old_delims = readline.get_completer_delims()
+    readline.set_completer(complete)
+    # names can contain spaces and such, so complete the whole line
+    readline.set_completer_delims('')
+    readline.parse_and_bind('tab: complete')
+    try:
+        yield
+    finally:
+        readline.set_completer(old_completer)
+        readline.set_completer_delims(old_delims)
 
 
 def backup(path) -> str:
     """renames a path with a backup timestamp"""
     path_backup = f"{path}.backup.{int(time.time())}"
-    logger.info(f"Backing up {path} to {path_backup}")
+    # no exists() check first; FileNotFoundError is raised if |path| is absent
     os.rename(path, path_backup)
+    logger.info(f"Backed up {path} to {path_backup}")
     return path_backup
 
 
@@ -124,63 +173,229 @@ rename = move
 
 
 def join_and_check(path, *sub) -> str:
-    """joins a path with os.path.join and ensures it os.path.exists()"""
-    path = os.path.join(path, *sub)
-    if not os.path.exists(path):
+    """joins a path with os.path.join and ensures it exists"""
+    joined = os.path.join(path, *sub)
+    try:
+        os.stat(joined)
+    except (FileNotFoundError, NotADirectoryError):
         raise FileNotFoundError(
             f"{os.path.join(*sub)} not found in {path}. "
-            f"{tegrity.err.BUNDLE_REINSTALL}")
-    return path
+            f"{tegrity.err.BUNDLE_REINSTALL}") from None
+    return joined
+
 
+def clone_tree(src, dst):
+    """
+    copies the directory tree |src| to (new) |dst| with cp -a, preserving
+    ownership, modes, and special files. --reflink=auto clones file data on
+    filesystems that can (btrfs, XFS), and cp copies it in-kernel otherwise.
+    """
+    logger.debug(f"copying {src} to {dst}")
+    run(('cp', '-a', '--reflink=auto', src, dst)).check_returncode()
 
-def estimate_size(folder) -> int:
+
+def _scan_usage(path) -> Tuple[int, Dict[Tuple[int, int], int], List[str]]:
+    """
+    scans a single directory (not recursively) for estimate_size
+
+    :returns: bytes allocated by the singly linked entries in |path|, a mapping
+    of (st_dev, st_ino) to bytes allocated for hard linked files, and a list of
+    subdirectories still to scan.
+    """
+    total = 0
+    linked = {}
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            stat = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif stat.st_nlink > 1:
+                linked[(stat.st_dev, stat.st_ino)] = stat.st_blocks * 512
+                continue
+            total += stat.st_blocks * 512
+    return total, linked, subdirs
+
+
+def estimate_size(folder, max_workers: Optional[int] = None) -> int:
     """gets the size estimate of a folder in GB (stupid storage manufacturer
-    powers of 1000) using du"""
+    powers of 1000), rounded up. Like du, this counts allocated blocks and
+    only counts hard linked files once. Every directory is queued as it's
+    found, so up to |max_workers| threads are scanning at once however
+    unbalanced the tree is."""
     logger.info(f"Estimating size of {folder}")
-    cp = tegrity.utils.run(
-        ('du', '-s', '-BGB', folder),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+    if not max_workers:
+        max_workers = min(16, 2 * (os.cpu_count() or 1))
+    total = 0
+    linked = {}
     try:
-        cp.check_returncode()
-    except subprocess.CalledProcessError:
-        logger.error(cp.stderr.decode())
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            pending = {executor.submit(_scan_usage, folder)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    sub_total, sub_linked, subdirs = future.result()
+                    total += sub_total
+                    linked.update(sub_linked)
+                    pending.update(
+                        executor.submit(_scan_usage, d) for d in subdirs)
+    except PermissionError:
         logger.error(
             "image size estimate might not be accurate. "
             "Are you running as root?")
         raise
-    # get the size in GB from the output
-    size, _ = cp.stdout.split()
-    # strip the end off and convert to integer
-    size = int(size.decode()[:-2])
+    total += os.lstat(folder).st_blocks * 512 + sum(linked.values())
+    # round up to the nearest GB, as du -BGB does
+    return -(-total // 10 ** 9)
+
+
+# mount(2) flags for the mount(8) options that map to one (linux only)
+MS_FLAGS = {
+    'ro': 1,  # MS_RDONLY
+    'rw': 0,
+    'nosuid': 2,  # MS_NOSUID
+    'nodev': 4,  # MS_NODEV
+    'noexec': 8,  # MS_NOEXEC
+    'sync': 16,  # MS_SYNCHRONOUS
+    'dirsync': 128,  # MS_DIRSYNC
+    'noatime': 1024,  # MS_NOATIME
+    'nodiratime': 2048,  # MS_NODIRATIME
+    'bind': 4096,  # MS_BIND
+    'rbind': 4096 | 16384,  # MS_BIND | MS_REC
+    'relatime': 1 << 21,  # MS_RELATIME
+    'strictatime': 1 << 24,  # MS_STRICTATIME
+}
+MS_RDONLY = MS_FLAGS['ro']
+MS_REMOUNT = 32
+MS_BIND = MS_FLAGS['bind']
+
+_libc = None
+
+
+def _get_libc() -> Optional[ctypes.CDLL]:
+    """:returns: libc (loaded once) if on linux, otherwise None"""
+    global _libc
+    if _libc is None and sys.platform.startswith('linux'):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name:
+            _libc = ctypes.CDLL(libc_name, use_errno=True)
+    return _libc
+
+
+def _mount_syscall(source, target,
+                   type_: Optional[str] = None,
+                   options: Optional[Iterable[str]] = None,) -> bool:
+    """
+    mounts using mount(2) directly, rather than forking mount(8)
 
-    return size
+    :returns: False if the mount couldn't be done this way (not linux, or an
+    option without a flag), so the caller can fall back to mount(8)
+    :raises: OSError if the syscall fails
+    """
+    libc = _get_libc()
+    if not libc:
+        return False
+    flags = 0
+    data = []
+    for option in options or ():
+        if option in MS_FLAGS:
+            flags |= MS_FLAGS[option]
+        elif '=' in option:
+            # filesystem specific, eg. gid=5 for devpts
+            data.append(option)
+        else:
+            return False
+
+    def _mount(flags_):
+        if libc.mount(
+                os.fsencode(source) if source else None,
+                os.fsencode(target),
+                os.fsencode(type_) if type_ else None,
+                ctypes.c_ulong(flags_),
+                ','.join(data).encode() if data else None):
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_), target)
+
+    _mount(flags)
+    if flags & MS_BIND and flags & ~MS_FLAGS['rbind']:
+        # the kernel ignores the other flags on the initial bind, so apply
+        # them with a remount, as mount(8) does
+        try:
+            _mount(MS_REMOUNT | MS_BIND | flags)
+        except OSError:
+            # undo the bind so the caller's fallback doesn't stack another
+            # mount on top of one that is never unmounted
+            if libc.umount2(os.fsencode(target), 0):
+                errno_ = ctypes.get_errno()
+                raise RuntimeError(
+                    f"remount of {target} failed and it could not be "
+                    f"unmounted: {os.strerror(errno_)}") from None
+            raise
+    return True
 
 
 def mount(source, target,
           type_: Optional[str] = None,
           options: Optional[Iterable[str]] = None,
           ) -> subprocess.CompletedProcess:
+    """
+    mounts |source| on |target|, with mount(2) where possible (no fork) and
+    mount(8) otherwise (or if the syscall fails, for it's error messages).
+
+    :return: subprocess.CompletedProcess of the (equivalent) mount command
+    """
     logger.info(f"Mounting {target}")
     command = ['mount']
     if type_:
         command.extend(('-t', str(type_)))
     if options:
+        options = sorted(options)
         command.append('-o')
-        command.append(','.join(sorted(options)))
+        command.append(','.join(options))
     command.extend((source, target))
+    try:
+        if _mount_syscall(source, target, type_, options):
+            logger.debug(f"mounted with mount(2): {' '.join(command)}")
+            return subprocess.CompletedProcess(command, 0)
+    except OSError as err:
+        logger.debug(f"mount(2) failed ({err}), falling back to mount(8)")
     return tegrity.utils.run(command)
 
 
+def _umount_syscall(target) -> bool:
+    """
+    unmounts using umount2(2) directly, rather than forking umount(8)
+
+    :returns: False if not on linux, so the caller can fall back to umount(8)
+    :raises: OSError if the syscall fails
+    """
+    libc = _get_libc()
+    if not libc:
+        return False
+    if libc.umount2(os.fsencode(target), 0):
+        errno_ = ctypes.get_errno()
+        raise OSError(errno_, os.strerror(errno_), target)
+    return True
+
+
 def umount(target) -> subprocess.CompletedProcess:
     """
-    unmounts a target path
+    unmounts a target path, with umount2(2) where possible (no fork) and
+    umount(8) otherwise (or if the syscall fails, for it's error messages).
+
     :arg target: the target to unmount
-    :return: subprocess.CompletedProcess of the unmount command
+    :return: subprocess.CompletedProcess of the (equivalent) unmount command
     """
     logger.info(f"Unmounting: {target}")
-    return tegrity.utils.run(('umount', target))
+    command = ('umount', target)
+    try:
+        if _umount_syscall(target):
+            logger.debug(f"unmounted with umount2(2): {target}")
+            return subprocess.CompletedProcess(command, 0)
+    except OSError as err:
+        logger.debug(f"umount2(2) failed ({err}), falling back to umount(8)")
+    return tegrity.utils.run(command)
 
 
 def ensure_sudo() -> str:
@@ -224,13 +439,16 @@ def ensure_config_path(
         tegrity.utils.mkdir(path, mode)
 
 
-def ensure_system_requirements(cross_prefix=None):
-    """ensures system requirements are installed and returns cross prefix"""
+def ensure_system_requirements(cross_prefix=None, toolchain_source=None):
+    """ensures system requirements are installed and returns cross prefix
+
+    :param toolchain_source: passed to tegrity.toolchain.ensure as source
+    """
     logger.info("Ensuring system requirements...")
     tegrity.utils.ensure_sudo()
     tegrity.apt.ensure_requirements()
     ensure_config_path()
-    return tegrity.toolchain.ensure(cross_prefix)
+    return tegrity.toolchain.ensure(cross_prefix, toolchain_source)
 
 
 if __name__ == '__main__':